@@ -1,22 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import csv
 import firebase_admin
 import json
+import math
 from collections import namedtuple
 from firebase_admin import credentials, firestore
+from lib.batch_writer import BatchWriter
+from lib.similarity import calculate_pair_stats, calculate_score, get_pair_ids_to_similarity_ids, get_user_ids_to_rated_place_ids, get_user_place_ratings
+from lib.similarity_matrix import build_rating_matrix, calculate_pair_stats_matrix, calculate_scores_matrix
+from lib.snapshot import add_snapshot_arguments, load_snapshot
 from os import environ
 
-def get_user_ids_to_data(db):
-    print('Getting users...')
+def get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    users = db.collection('users').stream()
-    for u in users:
-        user_dict = u.to_dict()
-        user_ids_to_data[u.id] = {
-            'handle': user_dict.get('handle'),
-            'friends': [f.id for f in user_dict.get('friends')],
-            'tasted': [p.id for p in user_dict.get('tasted')],
-            'hasSignedIn': user_dict.get('hasSignedIn', True),
+    for u, d in snapshot.users.rows():
+        user_ids_to_data[u] = {
+            'handle': d['handle'],
+            'friends': list(d['friends']),
+            'tasted': list(d['tasted']),
+            'hasSignedIn': d['hasSignedIn'],
         }
     return user_ids_to_data
 
@@ -32,68 +35,82 @@ def calculate_friend_sets(user_ids_to_data):
             friend_sets.add(frozenset([u, f]))
     return friend_sets
 
-def get_post_ids_to_data(db):
-    print('Getting posts...')
-    post_ids_to_data = {}
-    posts = db.collection('posts').stream()
-    for p in posts:
-        post_dict = p.to_dict()
-        post_ids_to_data[p.id] = {
-            'user': post_dict.get('user').id,
-            'place': post_dict.get('place').id,
-            'starRating': post_dict.get('starRating'),
-        }
-    return post_ids_to_data
-
-def get_similarity_ids_to_data(db):
-    print('Getting similarities...')
+def get_similarity_ids_to_data(snapshot):
     similarity_ids_to_data = {}
-    similarities = db.collection('similarities').stream()
-    for s in similarities:
-        similarity_dict = s.to_dict()
-        similarity_ids_to_data[s.id] = {
-            'users': s.get('users'),
-            'score': s.get('score')
+    for s, d in snapshot.table('similarities').rows():
+        similarity_ids_to_data[s] = {
+            'users': d['users'],
+            'score': d['score']
         }
     return similarity_ids_to_data
 
-def upsert_similarity(db, friend_set, user_ids_to_data, similarity_ids_to_data):
-    friend_list = list(friend_set)
-    u1 = friend_list[0]
-    u2 = friend_list[1]
-    u1_handle = user_ids_to_data[u1]['handle']
-    u2_handle = user_ids_to_data[u2]['handle']
-    common_places = list(set(user_ids_to_data[u1]['tasted']).intersection(set(user_ids_to_data[u2]['tasted'])))
+def calculate_similarities(friend_sets, user_ids_to_data, user_place_ratings):
+    print('Calculating similarities...')
+    user_ids_to_tasted = {u: d['tasted'] for u, d in user_ids_to_data.items()}
+    user_ids_to_rated_place_ids = get_user_ids_to_rated_place_ids(user_ids_to_tasted, user_place_ratings)
+    friend_sets_to_scores = {}
+    for fs in friend_sets:
+        u1, u2 = fs
+        count, diff = calculate_pair_stats(u1, u2, user_ids_to_rated_place_ids, user_place_ratings)
+        score = calculate_score(count, diff)
+        if score is None:
+            continue
+        friend_sets_to_scores[fs] = score
+    return friend_sets_to_scores
 
-    if len(common_places) < 5:
-        return
+def calculate_similarities_matrix(posts, friend_sets, user_ids_to_data):
+    print('Calculating similarities (matrix)...')
+    user_ids_to_tasted = {u: d['tasted'] for u, d in user_ids_to_data.items() if d['hasSignedIn']}
+    rating_matrix = build_rating_matrix(posts, user_ids_to_tasted)
+    user_indexes = rating_matrix.user_indexes
+    pairs = [(user_indexes[u1], user_indexes[u2]) for u1, u2 in friend_sets]
+    rows, cols, counts, diffs = calculate_pair_stats_matrix(rating_matrix, pairs)
+    scores = calculate_scores_matrix(counts, diffs)
+    friend_sets_to_scores = {}
+    for u1, u2, score in zip(rows, cols, scores):
+        if score != score:
+            continue
+        friend_sets_to_scores[frozenset([rating_matrix.user_ids[u1], rating_matrix.user_ids[u2]])] = float(score)
+    return rating_matrix, friend_sets_to_scores
 
-    max_diff = 4 * len(common_places)
-    diff = 0
-    for place_id in common_places:
-        u1_posts = [p for p, d in post_ids_to_data.items() if d['place'] == place_id and d['user'] == u1]
-        u2_posts = [p for p, d in post_ids_to_data.items() if d['place'] == place_id and d['user'] == u2]
-        u1_star_ratings = [post_ids_to_data[p]['starRating'] for p in u1_posts]
-        u2_star_ratings = [post_ids_to_data[p]['starRating'] for p in u2_posts]
-        u1_avg_star_rating = sum(u1_star_ratings) / len(u1_star_ratings)
-        u2_avg_star_rating = sum(u2_star_ratings) / len(u2_star_ratings)
-        diff += abs(u1_avg_star_rating - u2_avg_star_rating)
-    score = (max_diff - diff) / max_diff
+# scores every pair of signed-in users with enough common places that are not
+# already friends so they can be surfaced as friend suggestions
+def output_similarity_suggestions(rating_matrix, friend_sets, user_ids_to_data, suggestions_path):
+    print('Calculating similarity suggestions...')
+    rows, cols, counts, diffs = calculate_pair_stats_matrix(rating_matrix)
+    scores = calculate_scores_matrix(counts, diffs)
+    user_ids = rating_matrix.user_ids
+    suggestions = []
+    for u1, u2, count, score in zip(rows, cols, counts, scores):
+        pair = frozenset([user_ids[u1], user_ids[u2]])
+        if pair in friend_sets:
+            continue
+        suggestions.append((user_ids_to_data[user_ids[u1]]['handle'], user_ids_to_data[user_ids[u2]]['handle'], int(count), float(score)))
+    suggestions = sorted(suggestions, key=lambda s: s[3], reverse=True)
+    with open(suggestions_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user', 'other_user', 'common_places', 'score'])
+        writer.writerows(suggestions)
+
+def upsert_similarity(db, writer, friend_set, score, user_ids_to_data, similarity_ids_to_data, pair_ids_to_similarity_ids):
+    u1, u2 = friend_set
+    u1_handle = user_ids_to_data[u1]['handle']
+    u2_handle = user_ids_to_data[u2]['handle']
 
-    similarities = [s for s, d in similarity_ids_to_data.items() if u1 in d['users'].keys() and u2 in d['users'].keys()]
+    similarities = pair_ids_to_similarity_ids.get(friend_set, [])
     if len(similarities) == 1:
         similarity_id = similarities[0]
         similarity = similarity_ids_to_data[similarities[0]]
-        if similarity['score'] == score:
+        if math.isclose(similarity['score'], score, abs_tol=1e-9):
             print(f'Skipping updating similarity of {round(score, 2)} for {u1_handle}/{u2_handle}, already the same...')
             return
         print(f'Updating similarity of {round(score, 2)} for {u1_handle}/{u2_handle}...')
-        db.collection('similarities').document(similarity_id).update({
+        writer.update(db.collection('similarities').document(similarity_id), {
             'score': score
         })
     elif len(similarities) == 0:
         print(f'Inserting similarity of {round(score, 2)} for {u1_handle}/{u2_handle}...')
-        db.collection('similarities').add({
+        writer.set(db.collection('similarities').document(), {
             'users': {
                 u1: True,
                 u2: True,
@@ -106,6 +123,10 @@ def upsert_similarity(db, friend_set, user_ids_to_data, similarity_ids_to_data):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--mode', type=str, choices=['indexed', 'matrix'], default='indexed')
+    parser.add_argument('--suggestions-path', type=str, required=False)
+    parser.add_argument('--max-workers', type=int, default=8)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -121,9 +142,18 @@ if __name__ == '__main__':
             exit(0)
 
     db = firestore.client()
-    user_ids_to_data = get_user_ids_to_data(db)
-    post_ids_to_data = get_post_ids_to_data(db)
-    similarity_ids_to_data = get_similarity_ids_to_data(db)
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = get_user_ids_to_data(snapshot)
+    similarity_ids_to_data = get_similarity_ids_to_data(snapshot)
+    pair_ids_to_similarity_ids = get_pair_ids_to_similarity_ids(similarity_ids_to_data)
     friend_sets = calculate_friend_sets(user_ids_to_data)
-    for fs in friend_sets:
-        upsert_similarity(db, fs, user_ids_to_data, similarity_ids_to_data)
+    if args.mode == 'matrix':
+        rating_matrix, friend_sets_to_scores = calculate_similarities_matrix(snapshot.posts, friend_sets, user_ids_to_data)
+        if args.suggestions_path:
+            output_similarity_suggestions(rating_matrix, friend_sets, user_ids_to_data, args.suggestions_path)
+    else:
+        user_place_ratings = get_user_place_ratings(snapshot.posts)
+        friend_sets_to_scores = calculate_similarities(friend_sets, user_ids_to_data, user_place_ratings)
+    with BatchWriter(db, 'similarities', max_workers=args.max_workers) as writer:
+        for fs, score in friend_sets_to_scores.items():
+            upsert_similarity(db, writer, fs, score, user_ids_to_data, similarity_ids_to_data, pair_ids_to_similarity_ids)
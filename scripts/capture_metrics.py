@@ -1,76 +1,78 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
 import csv
 import datetime
 import firebase_admin
 import json
 import pytz
-from firebase_admin import auth, credentials, firestore
+from collections import Counter
+from firebase_admin import credentials, firestore
+from lib.auth_users import get_user_ids_to_auth_timestamps
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+from lib.timestamps import MICROS_PER_DAY, from_micros, now_micros, to_micros
 from os import environ
 
-def get_user_ids_to_data(db):
-    print('Getting authenticated users...')
+def get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    for u in auth.list_users().iterate_all():
-        auth_user = auth.get_user(u.uid)
-        users = db.collection('users').where('phoneNumber', '==', u.phone_number).get()
-        if len(users) != 1:
-            continue
-        epoch_creation_timestamp = auth_user.user_metadata.creation_timestamp / 1000
-        user = users[0]
-        user_ids_to_data[user.id] = {
-            'handle': user.get('handle'),
-            'phoneNumber': user.get('phoneNumber'),
-            'wantToTaste': user.get('wantToTaste'),
-            'friends': user.get('friends'),
-            'timestamp': datetime.datetime.fromtimestamp(epoch_creation_timestamp).replace(tzinfo=pytz.UTC)
+    for u, timestamp in get_user_ids_to_auth_timestamps(snapshot).items():
+        user = snapshot.users.get(u)
+        user_ids_to_data[u] = {
+            'handle': user['handle'],
+            'phoneNumber': user['phoneNumber'],
+            'wantToTaste': user['wantToTaste'],
+            'friends': user['friends'],
+            'timestamp': timestamp
         }
     return user_ids_to_data
 
-def get_post_ids_to_data(db):
-    print('Getting posts...')
+def get_post_ids_to_data(snapshot):
+    posts = snapshot.posts
     post_ids_to_data = {}
-    posts = db.collection('posts').get()
-    for p in posts:
-        post_ids_to_data[p.id] = {
-            'user': p.get('user').id,
-            'place': p.get('place').id,
-            'timestamp': p.get('timestamp').replace(tzinfo=pytz.UTC)
+    for i, p in enumerate(posts.ids):
+        post_ids_to_data[p] = {
+            'user': posts['user'][i],
+            'place': posts['place'][i],
+            'timestamp': posts['timestamp'][i]
         }
     return post_ids_to_data
 
-def get_reply_ids_to_data(db, post_ids_to_data):
-    print('Getting replies...')
+def get_reply_ids_to_data(snapshot):
+    replies = snapshot.table('replies')
     reply_ids_to_data = {}
-    for p in post_ids_to_data:
-        replies = db.collection('posts').document(p).collection('replies').get()
-        for r in replies:
-            reply_ids_to_data[r.id] = {
-                'timestamp': r.get('timestamp').replace(tzinfo=pytz.UTC)
-            }
+    for i, r in enumerate(replies.ids):
+        reply_ids_to_data[r] = {
+            'timestamp': replies['timestamp'][i]
+        }
     return reply_ids_to_data
 
-def get_notification_ids_to_data(db):
-    print('Getting notifications...')
+def get_notification_ids_to_data(snapshot):
+    notifications = snapshot.table('notifications')
     notification_ids_to_data = {}
-    notifications = db.collection('notifications').get()
-    for n in notifications:
-        notification_ids_to_data[n.id] = {
-            'timestamp': n.get('timestamp').replace(tzinfo=pytz.UTC)
+    for i, n in enumerate(notifications.ids):
+        notification_ids_to_data[n] = {
+            'timestamp': notifications['timestamp'][i]
         }
     return notification_ids_to_data
 
-def get_session_ids_to_data(db):
-    print('Getting sessions...')
+def get_session_ids_to_data(snapshot):
+    sessions = snapshot.table('sessions')
     session_ids_to_data = {}
-    sessions = db.collection('sessions').get()
-    for s in sessions:
-        session_ids_to_data[s.id] = {
-            'userPhoneNumber': s.get('userPhoneNumber'),
-            'timestamp': s.get('timestamp').replace(tzinfo=pytz.UTC)
+    for i, s in enumerate(sessions.ids):
+        session_ids_to_data[s] = {
+            'userPhoneNumber': sessions['userPhoneNumber'][i],
+            'timestamp': sessions['timestamp'][i]
         }
     return session_ids_to_data
 
+def _sorted_by_timestamp(ids_to_data):
+    data = sorted(ids_to_data.values(), key=lambda d: d['timestamp'])
+    return [d['timestamp'] for d in data], data
+
+# returns the slice bounds of sorted timestamps strictly between start and end
+def _window(timestamps, start, end):
+    return bisect.bisect_right(timestamps, start), bisect.bisect_left(timestamps, end)
+
 def calculate_raw_count_metrics(user_ids_to_data, post_ids_to_data, reply_ids_to_data, notification_ids_to_data):
     print('Calculating raw count metrics...')
     collections_to_maps = {
@@ -80,16 +82,19 @@ def calculate_raw_count_metrics(user_ids_to_data, post_ids_to_data, reply_ids_to
         'notifications': notification_ids_to_data
     }
 
+    collections_to_timestamps = {
+        c: sorted(d['timestamp'] for d in m.values()) for c, m in collections_to_maps.items()
+    }
+
     fields = ['date', 'users', 'posts', 'replies', 'notifications']
     rows = []
-    delta = datetime.timedelta(days=1)
-    start_date = datetime.datetime(2022, 1, 17).replace(tzinfo=pytz.UTC)
-    end_date = datetime.datetime.now().replace(tzinfo=pytz.UTC) - delta
+    delta = MICROS_PER_DAY
+    start_date = to_micros(datetime.datetime(2022, 1, 17).replace(tzinfo=pytz.UTC))
+    end_date = now_micros() - delta
     while start_date < end_date:
-        row = [start_date.date()]
+        row = [from_micros(start_date).date()]
         for f in  ['users', 'posts', 'replies', 'notifications']:
-            collection_map = collections_to_maps[f]
-            count = len([k for k, v in collection_map.items() if v['timestamp'] < start_date])
+            count = bisect.bisect_left(collections_to_timestamps[f], start_date)
             row.append(count)
         rows.append(row)
         start_date += delta
@@ -100,70 +105,82 @@ def calculate_raw_count_metrics(user_ids_to_data, post_ids_to_data, reply_ids_to
 
 def calculate_top_line_metrics(user_ids_to_data, post_ids_to_data, session_ids_to_data):
     print('Calculating top-line metrics...')
+    user_timestamps = sorted(d['timestamp'] for d in user_ids_to_data.values())
+    post_timestamps, sorted_posts = _sorted_by_timestamp(post_ids_to_data)
+    session_timestamps, sorted_sessions = _sorted_by_timestamp(session_ids_to_data)
+
     fields = ['start_week', 'users', 'posts', 'users_who_tasted', 'users_who_visited']
     rows = []
-    delta = datetime.timedelta(days=7)
-    start_date = datetime.datetime(2022, 1, 11).replace(tzinfo=pytz.UTC) # start on Tuesday
-    end_date = datetime.datetime.now().replace(tzinfo=pytz.UTC) - delta
+    delta = 7 * MICROS_PER_DAY
+    start_date = to_micros(datetime.datetime(2022, 1, 11).replace(tzinfo=pytz.UTC)) # start on Tuesday
+    end_date = now_micros() - delta
     while start_date < end_date:
-        users = [u for u, d in user_ids_to_data.items() if d['timestamp'] < start_date + delta]
-        posts = [d for p, d in post_ids_to_data.items() if start_date < d['timestamp'] < start_date + delta]
-        sessions = [d for s, d in session_ids_to_data.items() if start_date < d['timestamp'] < start_date + delta]
+        users_count = bisect.bisect_left(user_timestamps, start_date + delta)
+        lo, hi = _window(post_timestamps, start_date, start_date + delta)
+        posts = sorted_posts[lo:hi]
+        lo, hi = _window(session_timestamps, start_date, start_date + delta)
+        sessions = sorted_sessions[lo:hi]
         post_unique_user_ids = list(set([p['user'] for p in posts]))
         session_unique_user_ids = list(set([s['userPhoneNumber'] for s in sessions]))
-        rows.append([start_date.date(), len(users), len(posts), len(post_unique_user_ids), len(session_unique_user_ids)])
+        rows.append([from_micros(start_date).date(), users_count, len(posts), len(post_unique_user_ids), len(session_unique_user_ids)])
         start_date += delta
     with open(f'metrics/top_line.csv', 'w') as f:
         writer = csv.writer(f)
         writer.writerow(fields)
         writer.writerows(rows)
 
+# returns the index of the week whose window strictly contains the timestamp
+def _week_index(timestamp, start_date, delta):
+    offset = timestamp - start_date
+    if offset <= 0 or offset % delta == 0:
+        return None
+    return offset // delta
+
 def calculate_core_spread_metrics(user_ids_to_data, post_ids_to_data, session_ids_to_data):
     print('Calculating core spread metrics...')
-    week_to_user_taste_spread = {}
-    week_to_user_visit_spread = {}
-    week_to_place_spread = {}
-    delta = datetime.timedelta(days=7)
-    start_date = datetime.datetime(2022, 1, 11).replace(tzinfo=pytz.UTC) # start on Tuesday
-    end_date = datetime.datetime.now().replace(tzinfo=pytz.UTC) - delta
-    while start_date < end_date:
-        users = [u for u, d in user_ids_to_data.items() if d['timestamp'] < start_date + delta]
-
-        posts = [p for p, d in post_ids_to_data.items() if start_date < d['timestamp'] < start_date + delta]
-        users_to_posts = {}
-        for u in users:
-            user_posts = [p for p in posts if post_ids_to_data[p]['user'] == u]
-            users_to_posts[u] = user_posts
-        week_to_user_taste_spread[str(start_date.date())] = {
-            u: users_to_posts[u] for u in users
-        }
+    delta = 7 * MICROS_PER_DAY
+    start_date = to_micros(datetime.datetime(2022, 1, 11).replace(tzinfo=pytz.UTC)) # start on Tuesday
+    end_date = now_micros() - delta
+    weeks = []
+    week = start_date
+    while week < end_date:
+        weeks.append(week)
+        week += delta
 
-        sessions = [s for s, d in session_ids_to_data.items() if start_date < d['timestamp'] < start_date + delta]
-        users_to_sessions = {}
-        for u in users:
-            user_sessions = [s for s in sessions if session_ids_to_data[s]['userPhoneNumber'] == user_ids_to_data[u]['phoneNumber']]
-            users_to_sessions[u] = user_sessions
-        week_to_user_visit_spread[str(start_date.date())] = {
-            u: users_to_sessions[u] for u in users
-        }
+    # a user shows up in every week that ends after they were created
+    user_first_weeks = {u: max(0, (d['timestamp'] - start_date) // delta) for u, d in user_ids_to_data.items()}
+    users = sorted([u for u, w in user_first_weeks.items() if w < len(weeks)])
 
-        start_date += delta
+    week_user_taste_counts = Counter()
+    for d in post_ids_to_data.values():
+        w = _week_index(d['timestamp'], start_date, delta)
+        if w is not None and w < len(weeks):
+            week_user_taste_counts[(w, d['user'])] += 1
+
+    phone_number_to_user_ids = {}
+    for u, d in user_ids_to_data.items():
+        phone_number_to_user_ids.setdefault(d['phoneNumber'], []).append(u)
+    week_user_visit_counts = Counter()
+    for d in session_ids_to_data.values():
+        w = _week_index(d['timestamp'], start_date, delta)
+        if w is None or w >= len(weeks):
+            continue
+        for u in phone_number_to_user_ids.get(d['userPhoneNumber'], []):
+            week_user_visit_counts[(w, u)] += 1
 
-    for t in [('taste_spread.csv', week_to_user_taste_spread), ('visit_spread.csv', week_to_user_visit_spread)]:
+    for t in [('taste_spread.csv', week_user_taste_counts), ('visit_spread.csv', week_user_visit_counts)]:
         file_name = t[0]
-        spread = t[1]
+        week_user_counts = t[1]
         with open(f'metrics/{file_name}', 'w') as f:
             writer = csv.writer(f)
-            weeks = sorted(spread.keys())
-            writer.writerow(['users'] + weeks)
-            users = sorted(spread[weeks[-1]].keys())
+            writer.writerow(['users'] + [str(from_micros(w).date()) for w in weeks])
             for u in users:
                 row = [user_ids_to_data[u]['handle']]
-                for w in weeks:
-                    if u not in spread[w]:
+                for w in range(len(weeks)):
+                    if w < user_first_weeks[u]:
                         row.append('')
                     else:
-                        row.append(len(spread[w][u]))
+                        row.append(week_user_counts[(w, u)])
                 writer.writerow(row)
 
 # warning: results are dependent on time the function is run
@@ -171,7 +188,7 @@ def calculate_friend_graphs(user_ids_to_data):
     print('Calculating friend graphs...')
     user_to_friends = {}
     for u, d in user_ids_to_data.items():
-        friends = [user_ids_to_data[f.id]['handle'] for f in d['friends'] if f.id in user_ids_to_data]
+        friends = [user_ids_to_data[f]['handle'] for f in d['friends'] if f in user_ids_to_data]
         user_to_friends[u] = ' '.join(friends)
     with open('metrics/friend_graphs.csv', 'w') as f:
         writer = csv.writer(f)
@@ -186,7 +203,7 @@ def calculate_want_to_taste_counts(user_ids_to_data):
     print('Calculating want to taste counts...')
     user_to_want_to_taste = {}
     for u, d in user_ids_to_data.items():
-        friends = [user_ids_to_data[f.id]['handle'] for f in d['friends'] if f.id in user_ids_to_data]
+        friends = [user_ids_to_data[f]['handle'] for f in d['friends'] if f in user_ids_to_data]
         want_to_tastes = d['wantToTaste']
         user_to_want_to_taste[u] = len(want_to_tastes)
     with open('metrics/want_to_taste_counts.csv', 'w') as f:
@@ -199,16 +216,16 @@ def calculate_want_to_taste_counts(user_ids_to_data):
 
 def calculate_place_count(post_ids_to_data):
     print('Calculating place count...')
-    delta = datetime.timedelta(days=7)
-    start_date = datetime.datetime(2022, 1, 11).replace(tzinfo=pytz.UTC) # start on Tuesday
-    end_date = datetime.datetime.now().replace(tzinfo=pytz.UTC) - delta
+    delta = 7 * MICROS_PER_DAY
+    start_date = to_micros(datetime.datetime(2022, 1, 11).replace(tzinfo=pytz.UTC)) # start on Tuesday
+    end_date = now_micros() - delta
+    post_timestamps, sorted_posts = _sorted_by_timestamp(post_ids_to_data)
     week_to_place_counts = {}
     places_set = set()
     while start_date < end_date:
-        posts = [p for p, d in post_ids_to_data.items() if start_date < d['timestamp'] < start_date + delta]
-        week_places_set = set([post_ids_to_data[p]['place'] for p in posts])
-        places_set = places_set.union(week_places_set)
-        week_to_place_counts[str(start_date.date())] = len(places_set)
+        lo, hi = _window(post_timestamps, start_date, start_date + delta)
+        places_set.update(p['place'] for p in sorted_posts[lo:hi])
+        week_to_place_counts[str(from_micros(start_date).date())] = len(places_set)
         start_date += delta
     with open('metrics/place_counts.csv', 'w') as f:
         writer = csv.writer(f)
@@ -219,6 +236,7 @@ def calculate_place_count(post_ids_to_data):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -233,11 +251,12 @@ if __name__ == '__main__':
         exit(1)
 
     db = firestore.client()
-    user_ids_to_data = get_user_ids_to_data(db)
-    post_ids_to_data = get_post_ids_to_data(db)
-    reply_ids_to_data = get_reply_ids_to_data(db, post_ids_to_data)
-    notification_ids_to_data = get_notification_ids_to_data(db)
-    session_ids_to_data = get_session_ids_to_data(db)
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = get_user_ids_to_data(snapshot)
+    post_ids_to_data = get_post_ids_to_data(snapshot)
+    reply_ids_to_data = get_reply_ids_to_data(snapshot)
+    notification_ids_to_data = get_notification_ids_to_data(snapshot)
+    session_ids_to_data = get_session_ids_to_data(snapshot)
     calculate_raw_count_metrics(user_ids_to_data, post_ids_to_data, reply_ids_to_data, notification_ids_to_data)
     calculate_top_line_metrics(user_ids_to_data, post_ids_to_data, session_ids_to_data)
     calculate_core_spread_metrics(user_ids_to_data, post_ids_to_data, session_ids_to_data)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import argparse
+import firebase_admin
+import json
+from firebase_admin import credentials, firestore
+from lib.snapshot import Snapshot
+from lib.snapshot_cache import SnapshotCache
+from os import environ
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--snapshot-path', type=str, required=True)
+    parser.add_argument('--snapshot-cache-path', type=str, required=False)
+    parser.add_argument('--full-sync', action='store_true')
+    parser.add_argument('--collections', type=str, nargs='+', default=['users', 'posts', 'places'])
+    args = parser.parse_args()
+
+    token_dict = None
+    with open(args.cert_path, 'r') as f:
+        token_dict = json.load(f)
+
+    credentials = credentials.Certificate(token_dict)
+    firebase_admin.initialize_app(credentials)
+
+    if not 'FIRESTORE_EMULATOR_HOST' in environ and 'BYPASS_FIREBASE_PRODUCTION_PROMPT' not in environ:
+        confirm = input('WARNING: connected to production, type "y" to continue: ')
+        if confirm != "y":
+            exit(0)
+
+    db = firestore.client()
+    cache = SnapshotCache(args.snapshot_cache_path, args.full_sync) if args.snapshot_cache_path else None
+    snapshot = Snapshot(db, cache=cache)
+    for c in args.collections:
+        snapshot.table(c)
+    snapshot.save(args.snapshot_path)
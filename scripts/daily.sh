@@ -1,7 +1,13 @@
 #!/usr/bin/env bash
 
+# every step reads the snapshot written by create_snapshot.py, so stop at the
+# first failure rather than writing from stale data
+set -e
+
 REPO_ROOT=$(git rev-parse --show-toplevel)
 CERT_PATH=${REPO_ROOT}/secret/taste-app-dbf1d-c271472aaf01.json
+SNAPSHOT_PATH=${REPO_ROOT}/tmp/snapshot.pickle
+SNAPSHOT_CACHE_PATH=${REPO_ROOT}/tmp/snapshot.sqlite3
 
 source ${REPO_ROOT}/env/bin/activate
 export BYPASS_FIREBASE_PRODUCTION_PROMPT=1
@@ -9,12 +15,17 @@ export BYPASS_FIREBASE_PRODUCTION_PROMPT=1
 echo "Running sanitize_users.py..."
 ${REPO_ROOT}/scripts/sanitize_users.py --cert-path ${CERT_PATH}
 
+echo "Running create_snapshot.py..."
+mkdir -p ${REPO_ROOT}/tmp
+rm -f ${SNAPSHOT_PATH}
+${REPO_ROOT}/scripts/create_snapshot.py --cert-path ${CERT_PATH} --snapshot-path ${SNAPSHOT_PATH} --snapshot-cache-path ${SNAPSHOT_CACHE_PATH}
+
 echo "Running Emerald scripts..."
-${REPO_ROOT}/scripts/emerald/create_emerald_events.py --cert-path ${CERT_PATH}
-${REPO_ROOT}/scripts/emerald/calculate_emerald_creds.py --cert-path ${CERT_PATH}
+${REPO_ROOT}/scripts/emerald/create_emerald_events.py --cert-path ${CERT_PATH} --snapshot-path ${SNAPSHOT_PATH} --snapshot-cache-path ${SNAPSHOT_CACHE_PATH}
+${REPO_ROOT}/scripts/emerald/calculate_emerald_creds.py --cert-path ${CERT_PATH} --state-path ${REPO_ROOT}/tmp/emerald_creds.json --rank-history-path ${REPO_ROOT}/tmp/emerald_ranks.json --snapshot-path ${SNAPSHOT_PATH} --snapshot-cache-path ${SNAPSHOT_CACHE_PATH}
 
-echo "Running set_posts_cuisines.py..."
-${REPO_ROOT}/scripts/set_posts_cuisines.py --cert-path ${CERT_PATH}
+echo "Running denormalize.py..."
+${REPO_ROOT}/scripts/denormalize.py --cert-path ${CERT_PATH} --fields places.cuisines places.postsCount posts.cuisines --snapshot-path ${SNAPSHOT_PATH} --snapshot-cache-path ${SNAPSHOT_CACHE_PATH}
 
-echo "Running set_places_posts.py..."
-${REPO_ROOT}/scripts/set_places_posts.py --cert-path ${CERT_PATH}
+echo "Running update_similarities.py..."
+${REPO_ROOT}/scripts/update_similarities.py --cert-path ${CERT_PATH} --state-path ${REPO_ROOT}/tmp/similarities.json --snapshot-path ${SNAPSHOT_PATH} --snapshot-cache-path ${SNAPSHOT_CACHE_PATH}
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import argparse
+import firebase_admin
+import json
+from firebase_admin import credentials, firestore
+from lib.denormalize import DerivedField, GroupSource, RefSource, SKIP, calculate_patches, get_derived_field_name, write_patches
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+from os import environ
+
+# places without cuisines get [""] so they match cuisine filters; the snapshot
+# reads a missing field as None
+def reduce_place_cuisines(place):
+    return [''] if place['cuisines'] is None else SKIP
+
+def reduce_place_posts_count(place, posts):
+    return len(posts)
+
+def reduce_post_cuisines(post, place):
+    return SKIP if place is None else place['cuisines']
+
+def reduce_post_reply_owner_refs(post, replies):
+    return [r['owner'] for r in replies] if len(replies) > 0 else SKIP
+
+def equal_reply_owner_refs(current_owner_ids, owner_ids):
+    return set(current_owner_ids) == set(owner_ids)
+
+def encode_reply_owner_refs(db, owner_ids):
+    return [db.collection('users').document(o) for o in owner_ids]
+
+# posts.replyOwnerRefs streams every reply (replies bypass the snapshot cache),
+# so daily.sh leaves it out and it is run on demand with --fields
+DERIVED_FIELDS = [
+    DerivedField('places', 'cuisines', [], reduce_place_cuisines),
+    DerivedField('places', 'postsCount', [GroupSource('posts', 'place')], reduce_place_posts_count),
+    DerivedField('posts', 'cuisines', [RefSource('places', 'place')], reduce_post_cuisines),
+    DerivedField('posts', 'replyOwnerRefs', [GroupSource('replies', 'post')], reduce_post_reply_owner_refs, equal_reply_owner_refs, encode_reply_owner_refs),
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--fields', type=str, nargs='+', choices=[get_derived_field_name(f) for f in DERIVED_FIELDS])
+    parser.add_argument('--max-workers', type=int, default=8)
+    add_snapshot_arguments(parser)
+    args = parser.parse_args()
+
+    token_dict = None
+    with open(args.cert_path, 'r') as f:
+        token_dict = json.load(f)
+
+    credentials = credentials.Certificate(token_dict)
+    firebase_admin.initialize_app(credentials)
+
+    if not 'FIRESTORE_EMULATOR_HOST' in environ and 'BYPASS_FIREBASE_PRODUCTION_PROMPT' not in environ:
+        confirm = input('WARNING: connected to production, type "y" to continue: ')
+        if confirm != "y":
+            exit(0)
+
+    db = firestore.client()
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    derived_fields = [f for f in DERIVED_FIELDS if args.fields is None or get_derived_field_name(f) in args.fields]
+    patches = calculate_patches(snapshot, derived_fields)
+    write_patches(db, patches, derived_fields, args.max_workers)
@@ -1,125 +1,167 @@
 #!/usr/bin/env python3
 import argparse
-import csv
 import datetime
 import firebase_admin
 import json
-import pytz
+import os
+import sys
 from firebase_admin import credentials, firestore
 from os import environ
 
-def _get_user_ids_to_data(db):
-    print('Getting users...')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.batch_writer import BatchWriter
+from lib.leaderboard import get_latest_rank_snapshot, get_rank_changes, load_rank_history, save_rank_snapshot, update_top_user_ids
+from lib.notifications import NotificationWriter
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+from lib.state import load_state, save_state
+from lib.timestamps import MISSING, micros_to_seconds
+
+'''
+State
+
+watermark       epoch seconds of the newest event createdAt already folded in
+creds           user ID -> creds from all events folded in so far
+
+Without a state every event is folded in, including events published before
+createdAt was set. Afterwards only events created after the watermark are
+read, so a run costs as much as the events published since the last one.
+'''
+
+EVENT_TYPES_TO_CREDS = {
+    'UserPostedTaste': 1,
+    'UserTastedPlaceFirst': 2,
+    'FriendWantsToTastePlaceYouTasted': 3,
+    'FriendTastedPlaceYouTasted': 4,
+    'FriendLikedPlaceYouTasted': 5
+}
+
+def _get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    users = db.collection('users').stream()
-    for u in users:
-        user_dict = u.to_dict()
-        user_ids_to_data[u.id] = {
-            'firstName': user_dict.get('firstName'),
-            'lastName': user_dict.get('lastName'),
-            'handle': user_dict.get('handle'),
-            'emerald': user_dict.get('emerald', False),
-            'emeraldCreds': user_dict.get('emeraldCreds', 0),
-            'friends': [f.id for f in user_dict.get('friends')]
+    for u, d in snapshot.users.rows():
+        user_ids_to_data[u] = {
+            'firstName': d['firstName'],
+            'lastName': d['lastName'],
+            'handle': d['handle'],
+            'emerald': d['emerald'],
+            'emeraldCreds': d['emeraldCreds'],
+            'friends': list(d['friends'])
         }
     return user_ids_to_data
 
-def _get_event_ids_to_data(db):
-    print('Getting events...')
-    event_ids_to_data = {}
-    events = db.collection('events').stream()
-    for e in events:
-        event_dict = e.to_dict()
-        event_ids_to_data[e.id] = event_dict
-    return event_ids_to_data
-
-def set_user_creds(db, user_ids_to_data, event_ids_to_data):
-    event_type_to_creds = {
-        'UserPostedTaste': 1,
-        'UserTastedPlaceFirst': 2,
-        'FriendWantsToTastePlaceYouTasted': 3,
-        'FriendTastedPlaceYouTasted': 4,
-        'FriendLikedPlaceYouTasted': 5
+def build_cred_ledger(snapshot):
+    print('Building cred ledger from all events...')
+    events = snapshot.table('events')
+    creds = {}
+    watermark = MISSING
+    for i in range(len(events)):
+        u = events['user'][i]
+        creds[u] = creds.get(u, 0) + EVENT_TYPES_TO_CREDS[events['type'][i]]
+        watermark = max(watermark, events['createdAt'][i])
+    return {
+        'watermark': micros_to_seconds(watermark),
+        'creds': creds
     }
-    user_ids_to_creds = {}
 
-    for u in user_ids_to_data:
-        print(f'Processing user {u}...')
-        creds = 0
-        events = [e for _, e in event_ids_to_data.items() if e['user'] == u]
-        for event in events:
-            event_type = event['type']
-            creds += event_type_to_creds[event_type]
-        user_ids_to_creds[u] = creds
-        db.collection('users').document(u).update({
-            'emeraldCreds': creds
-        })
+def apply_new_events(db, ledger):
+    print('Getting new events...')
+    query = db.collection('events')
+    if ledger['watermark'] is not None:
+        since = datetime.datetime.fromtimestamp(ledger['watermark'], tz=datetime.timezone.utc)
+        query = query.where('createdAt', '>', since)
+    else:
+        query = query.order_by('createdAt')
+    num_events = 0
+    creds = ledger['creds']
+    for e in query.select(['user', 'type', 'createdAt']).stream():
+        event_dict = e.to_dict()
+        u = event_dict['user']
+        creds[u] = creds.get(u, 0) + EVENT_TYPES_TO_CREDS[event_dict['type']]
+        ledger['watermark'] = max(ledger['watermark'] or 0, event_dict['createdAt'].timestamp())
+        num_events += 1
+    print(f'Applied {num_events} new events...')
+
+def set_user_creds(db, user_ids_to_data, ledger, max_workers=8):
+    user_ids_to_creds = {}
+    with BatchWriter(db, 'creds', max_workers=max_workers) as writer:
+        for u, d in user_ids_to_data.items():
+            creds = ledger['creds'].get(u, 0)
+            user_ids_to_creds[u] = creds
+            if creds == d['emeraldCreds']:
+                continue
+            print(f'Setting creds of {d["handle"]} from {d["emeraldCreds"]} to {creds}...')
+            writer.update(db.collection('users').document(u), {
+                'emeraldCreds': creds
+            })
     return user_ids_to_creds
 
-def calculate_emerald_user_ids(user_ids_to_creds):
-    tuples = [(u, c) for u, c in user_ids_to_creds.items()]
-    tuples = sorted(tuples, key=lambda t: t[1], reverse=True)
-
-    emerald_user_ids = []
-    num_emerald_ranks = 20
-    i = 0
-    while i < num_emerald_ranks:
-        user_id, creds = tuples[i]
-        emerald_user_ids.append(user_id)
-        j = i + 1
-        while j < len(user_ids_to_creds):
-            next_user_id, next_creds = tuples[j]
-            if next_creds == creds:
-                emerald_user_ids.append(next_user_id)
-                j += 1
-            else:
-                break
-        i = j
-    return emerald_user_ids
-
-def process_emerald_statuses(db, user_ids_to_data, current_emerald_user_ids, updated_emerald_user_ids):
+# the previous leaderboard is only reused if it was taken with the creds that
+# are stored on the users, i.e. the last run wrote creds and saved its ranks
+def calculate_emerald_user_ids(user_ids_to_data, user_ids_to_creds, rank_history):
+    user_ids_to_previous_creds = {u: d['emeraldCreds'] for u, d in user_ids_to_data.items()}
+    _, previous_user_ids_to_creds = get_latest_rank_snapshot(rank_history)
+    previous_top_user_ids = None
+    if previous_user_ids_to_creds is not None and all(user_ids_to_previous_creds.get(u) == c for u, c in previous_user_ids_to_creds.items()):
+        previous_top_user_ids = list(previous_user_ids_to_creds.keys())
+    return update_top_user_ids(previous_top_user_ids, user_ids_to_creds, user_ids_to_previous_creds)
+
+def print_rank_changes(user_ids_to_data, rank_history, today, emerald_user_ids, user_ids_to_creds):
+    date, previous_user_ids_to_creds = get_latest_rank_snapshot(rank_history, today)
+    if date is None:
+        return
+    entered, left, moved = get_rank_changes(list(previous_user_ids_to_creds.keys()), previous_user_ids_to_creds, emerald_user_ids, user_ids_to_creds)
+    print(f'Leaderboard changes since {date}:')
+    for u in entered:
+        print(f'  {user_ids_to_data[u]["handle"]} entered the top')
+    for u in left:
+        print(f'  {user_ids_to_data[u]["handle"]} left the top')
+    for u, previous_rank, rank in moved:
+        print(f'  {user_ids_to_data[u]["handle"]} moved from {previous_rank} to {rank}')
+
+def get_emerald_status_changes(current_emerald_user_ids, updated_emerald_user_ids):
     remove_emerald_user_ids = list(set(current_emerald_user_ids) - set(updated_emerald_user_ids))
     award_emerald_user_ids = list(set(updated_emerald_user_ids) - set(current_emerald_user_ids))
+    return remove_emerald_user_ids, award_emerald_user_ids
+
+def process_emerald_statuses(db, user_ids_to_data, current_emerald_user_ids, updated_emerald_user_ids, max_workers=8, confirm=True):
+    remove_emerald_user_ids, award_emerald_user_ids = get_emerald_status_changes(current_emerald_user_ids, updated_emerald_user_ids)
     print('Will remove Emerald from: ', [user_ids_to_data[u]['handle'] for u in remove_emerald_user_ids])
     print('Will assign Emerald to: ', [user_ids_to_data[u]['handle'] for u in award_emerald_user_ids])
     if len(remove_emerald_user_ids) == 0 and len(award_emerald_user_ids) == 0:
         return
-    confirm = input('Type "y" to continue: ')
-    if confirm != 'y':
+    if confirm and input('Type "y" to continue: ') != 'y':
         exit(0)
-    for u in remove_emerald_user_ids:
-        print(f'Removing Emerald status from {user_ids_to_data[u]["handle"]} and creating notifications...')
-        db.collection('users').document(u).update({
-            'emerald': False
-        })
-        db.collection('notifications').add({
-            'ownerId': u,
-            'type': 'YouLostTasteEmerald',
-            'title': "You've just lost Taste Emerald",
-            'body': 'Get it back by earning more creds',
-            'notificationIcon': u,
-            'notificationLink': u,
-            'seen': False,
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
-    for u in award_emerald_user_ids:
-        print(f'Awarding Emerald status to {user_ids_to_data[u]["handle"]} and creating notifications...')
-        db.collection('users').document(u).update({
-            'emerald': True
-        })
-        db.collection('notifications').add({
-            'ownerId': u,
-            'type': 'YouWereAwardedTasteEmerald',
-            'title': "You've just been awarded Taste Emerald",
-            'body': 'You consistently recommend great places to your friends - keep it up',
-            'notificationIcon': u,
-            'notificationLink': u,
-            'seen': False,
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
-        for f in user_ids_to_data[u]['friends']:
-            db.collection('notifications').add({
-                'ownerId': f,
+    with BatchWriter(db, 'statuses', max_workers=max_workers) as status_writer, NotificationWriter(db, max_workers=max_workers) as notification_writer:
+        for u in remove_emerald_user_ids:
+            print(f'Removing Emerald status from {user_ids_to_data[u]["handle"]} and creating notifications...')
+            status_writer.update(db.collection('users').document(u), {
+                'emerald': False
+            })
+            notification_writer.add({
+                'ownerId': u,
+                'type': 'YouLostTasteEmerald',
+                'title': "You've just lost Taste Emerald",
+                'body': 'Get it back by earning more creds',
+                'notificationIcon': u,
+                'notificationLink': u,
+                'seen': False,
+                'timestamp': firestore.SERVER_TIMESTAMP
+            })
+        for u in award_emerald_user_ids:
+            print(f'Awarding Emerald status to {user_ids_to_data[u]["handle"]} and creating notifications...')
+            status_writer.update(db.collection('users').document(u), {
+                'emerald': True
+            })
+            notification_writer.add({
+                'ownerId': u,
+                'type': 'YouWereAwardedTasteEmerald',
+                'title': "You've just been awarded Taste Emerald",
+                'body': 'You consistently recommend great places to your friends - keep it up',
+                'notificationIcon': u,
+                'notificationLink': u,
+                'seen': False,
+                'timestamp': firestore.SERVER_TIMESTAMP
+            })
+            notification_writer.fan_out(user_ids_to_data[u]['friends'], {
                 'type': 'FriendWasAwardedTasteEmerald',
                 'title': f'{user_ids_to_data[u]["firstName"]} was just awarded Taste Emerald',
                 'body': 'They consistently recommend great places to their friends - check out their tastes',
@@ -132,6 +174,12 @@ def process_emerald_statuses(db, user_ids_to_data, current_emerald_user_ids, upd
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--state-path', type=str, required=True)
+    parser.add_argument('--rank-history-path', type=str, required=True)
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--yes', action='store_true')
+    parser.add_argument('--max-workers', type=int, default=8)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -148,9 +196,20 @@ if __name__ == '__main__':
 
     db = firestore.client()
 
-    user_ids_to_data = _get_user_ids_to_data(db)
-    event_ids_to_data = _get_event_ids_to_data(db)
-    user_ids_to_creds = set_user_creds(db, user_ids_to_data, event_ids_to_data)
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = _get_user_ids_to_data(snapshot)
+    ledger = None if args.rebuild else load_state(args.state_path)
+    if ledger is None:
+        ledger = build_cred_ledger(snapshot)
+    else:
+        apply_new_events(db, ledger)
+    user_ids_to_creds = set_user_creds(db, user_ids_to_data, ledger, args.max_workers)
+    save_state(args.state_path, ledger)
     current_emerald_user_ids = [u for u, d in user_ids_to_data.items() if d['emerald']]
-    updated_emerald_user_ids = calculate_emerald_user_ids(user_ids_to_creds)
-    process_emerald_statuses(db, user_ids_to_data, current_emerald_user_ids, updated_emerald_user_ids)
+    rank_history = load_rank_history(args.rank_history_path)
+    updated_emerald_user_ids = calculate_emerald_user_ids(user_ids_to_data, user_ids_to_creds, rank_history)
+    today = datetime.date.today()
+    print_rank_changes(user_ids_to_data, rank_history, today, updated_emerald_user_ids, user_ids_to_creds)
+    save_rank_snapshot(args.rank_history_path, rank_history, today, updated_emerald_user_ids, user_ids_to_creds)
+    # awarding and removing Emerald always waits for a person unless --yes
+    process_emerald_statuses(db, user_ids_to_data, current_emerald_user_ids, updated_emerald_user_ids, args.max_workers, not args.yes)
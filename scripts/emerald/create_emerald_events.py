@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 import argparse
 import csv
-import datetime
 import firebase_admin
+import hashlib
 import json
-import pytz
+import numpy as np
+import os
+import sys
 from firebase_admin import credentials, firestore
 from os import environ
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.batch_writer import BatchWriter
+from lib.emerald_events_columnar import build_post_arrays, create_events_for_friend_tasted_liked_place_you_tasted_columnar, create_events_for_user_posted_taste_columnar, create_events_for_user_tasted_place_first_columnar
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+from lib.timestamps import from_micros
+
 '''
 Type                                Data
 
@@ -16,74 +24,104 @@ UserTastedPlaceFirst                Post ID
 FriendWantsToTastePlaceYouTasted    Place ID, user ID (friend)
 FriendTastedPlaceYouTasted          Post ID (friend)
 FriendLikedPlaceYouTasted           Post ID (friend)
+
+Event documents are keyed by a hash of their type, user and data, and are
+written in the same batch as the deletes of the queue entries they were
+generated from. A run that stops part way leaves exactly the unprocessed
+queue entries behind, and rerunning it regenerates their events under the
+same IDs, so no event is lost or awarded twice. Events that already exist are
+not rewritten, which keeps their createdAt (the cursor calculate_emerald_creds
+folds new events by) unchanged. Queued posts missing from the snapshot are
+read from Firestore: if the post exists (created after the snapshot was taken,
+or a stale snapshot) the entry is left in the queue for the next run, and if
+the post was deleted the entry is deleted without events.
 '''
 
-def _get_post_ids_to_data(db):
-    print('Getting posts...')
+_GET_ALL_CHUNK_SIZE = 300
+
+def _get_post_ids_to_data(snapshot):
+    posts = snapshot.posts
     post_ids_to_data = {}
-    posts = db.collection('posts').stream()
-    for p in posts:
-        post_dict = p.to_dict()
-        post_ids_to_data[p.id] = {
-            'id': p.id,
-            'user': post_dict.get('user').id,
-            'place': post_dict.get('place').id,
-            'starRating': post_dict.get('starRating'),
-            'review': post_dict.get('review'),
-            'retaste': post_dict.get('retaste', False),
-            'timestamp': post_dict.get('timestamp').replace(tzinfo=pytz.UTC)
+    for i, p in enumerate(posts.ids):
+        post_ids_to_data[p] = {
+            'id': p,
+            'user': posts['user'][i],
+            'place': posts['place'][i],
+            'starRating': posts['starRating'][i],
+            'review': posts['review'][i],
+            'retaste': bool(posts['retaste'][i]),
+            'timestamp': posts['timestamp'][i]
         }
     return post_ids_to_data
 
-def _get_user_ids_to_data(db):
-    print('Getting users...')
+def _get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    users = db.collection('users').stream()
-    for u in users:
-        user_dict = u.to_dict()
-        user_ids_to_data[u.id] = {
-            'firstName': user_dict.get('firstName'),
-            'lastName': user_dict.get('lastName'),
-            'handle': user_dict.get('handle'),
-            'wantToTaste': [p.id for p in user_dict.get('wantToTaste')],
-            'friends': [f.id for f in user_dict.get('friends')]
+    for u, d in snapshot.users.rows():
+        user_ids_to_data[u] = {
+            'firstName': d['firstName'],
+            'lastName': d['lastName'],
+            'handle': d['handle'],
+            'wantToTaste': list(d['wantToTaste']),
+            'friends': set(d['friends'])
         }
     return user_ids_to_data
 
-def _get_place_ids_to_data(db):
-    print('Getting places...')
+def _get_place_ids_to_data(snapshot):
     place_ids_to_data = {}
-    places = db.collection('places').stream()
-    for p in places:
-        place_dict = p.to_dict()
-        place_ids_to_data[p.id] = {
-            'id': p.id,
-            'name': place_dict.get('name')
+    for p, d in snapshot.places.rows():
+        place_ids_to_data[p] = {
+            'id': p,
+            'name': d['name']
         }
     return place_ids_to_data
 
-def _get_queue_post_ids_to_data(db, post_ids_to_data):
-    print('Getting posts queue...')
+def _get_queue_post_ids_to_data(snapshot):
+    queue_posts = snapshot.table('queueposts')
     queue_post_ids_to_data = {}
-    queue_posts = db.collection('queueposts').stream()
-    for p in queue_posts:
-        queue_post_data = p.to_dict()
-        queue_post_ids_to_data[p.id] = {
-            'postId': queue_post_data.get('postId')
+    for i, p in enumerate(queue_posts.ids):
+        queue_post_ids_to_data[p] = {
+            'postId': queue_posts['postId'][i]
         }
     return queue_post_ids_to_data
 
-def _get_queue_want_to_taste_ids_to_data(db):
-    print('Getting want to taste queue...')
+# splits off the queued posts whose post is not in the snapshot: those whose
+# post still exists are left for the next run, and those whose post was
+# deleted are returned separately so their entries are deleted without events
+def _get_ready_queue_post_ids_to_data(db, queue_post_ids_to_data, post_ids_to_data):
+    ready_queue_post_ids_to_data = {}
+    missing_post_ids = set()
+    for q, d in queue_post_ids_to_data.items():
+        if d['postId'] in post_ids_to_data:
+            ready_queue_post_ids_to_data[q] = d
+        else:
+            missing_post_ids.add(d['postId'])
+    if len(missing_post_ids) == 0:
+        return ready_queue_post_ids_to_data, {}
+
+    print(f'Getting {len(missing_post_ids)} queued posts missing from the snapshot...')
+    post_refs = [db.collection('posts').document(p) for p in sorted(missing_post_ids)]
+    existing_post_ids = set()
+    for i in range(0, len(post_refs), _GET_ALL_CHUNK_SIZE):
+        for p in db.get_all(post_refs[i:i + _GET_ALL_CHUNK_SIZE], field_paths=['timestamp']):
+            if p.exists:
+                existing_post_ids.add(p.id)
+    deleted_queue_post_ids_to_data = {q: d for q, d in queue_post_ids_to_data.items() if d['postId'] in missing_post_ids - existing_post_ids}
+    num_deferred = len(queue_post_ids_to_data) - len(ready_queue_post_ids_to_data) - len(deleted_queue_post_ids_to_data)
+    if num_deferred > 0:
+        print(f'WARNING: {num_deferred} queued posts are not in the snapshot, leaving them for the next run...')
+    if len(deleted_queue_post_ids_to_data) > 0:
+        print(f'Dropping {len(deleted_queue_post_ids_to_data)} queued posts whose post was deleted...')
+    return ready_queue_post_ids_to_data, deleted_queue_post_ids_to_data
+
+def _get_queue_want_to_taste_ids_to_data(snapshot):
+    want_to_tastes = snapshot.table('queuewanttotastes')
     queue_want_to_taste_ids_to_data = {}
-    want_to_tastes = db.collection('queuewanttotastes').stream()
-    for w in want_to_tastes:
-        want_to_taste_dict = w.to_dict()
-        queue_want_to_taste_ids_to_data[w.id] = {
-            'id': w.id,
-            'user': w.get('user').id,
-            'place': w.get('place').id,
-            'timestamp': w.get('timestamp')
+    for i, w in enumerate(want_to_tastes.ids):
+        queue_want_to_taste_ids_to_data[w] = {
+            'id': w,
+            'user': want_to_tastes['user'][i],
+            'place': want_to_tastes['place'][i],
+            'timestamp': want_to_tastes['timestamp'][i]
         }
     return queue_want_to_taste_ids_to_data
 
@@ -98,6 +136,33 @@ def _get_place_ids_to_post_data(post_ids_to_data):
             place_ids_to_post_data[place_id] = [post_data]
     return place_ids_to_post_data
 
+# maps place IDs to the first post of each user at the place (retastes and,
+# with min_star_rating, lower rated posts filtered out) in timestamp order,
+# along with the index of each user's first post in that list
+def _get_place_ids_to_first_post_data(place_ids_to_post_data, min_star_rating=None):
+    place_ids_to_first_post_data = {}
+    for place_id, place_post_data in place_ids_to_post_data.items():
+        first_posts = []
+        user_ids_to_indexes = {}
+        for p in sorted(place_post_data, key=lambda p: p['timestamp']):
+            if min_star_rating is not None and not p['starRating'] >= min_star_rating:
+                continue
+            if p['user'] in user_ids_to_indexes:
+                continue
+            user_ids_to_indexes[p['user']] = len(first_posts)
+            first_posts.append(p)
+        place_ids_to_first_post_data[place_id] = {
+            'posts': first_posts,
+            'indexes': user_ids_to_indexes
+        }
+    return place_ids_to_first_post_data
+
+def _get_first_post_index(first_post_data, post):
+    index = first_post_data['indexes'].get(post['user'])
+    if index is None or first_post_data['posts'][index]['id'] != post['id']:
+        return None
+    return index
+
 def _get_place_ids_to_queue_post_data(post_ids_to_data, queue_post_ids_to_data):
     print('Getting place IDs to queue post data...')
     place_ids_to_queue_post_data = {}
@@ -116,18 +181,11 @@ def _get_place_ids_to_queue_post_data(post_ids_to_data, queue_post_ids_to_data):
 def _get_place_ids_to_want_to_taste_data(place_ids_to_data, queue_want_to_taste_ids_to_data):
     print('Getting place IDs to queue want to taste data...')
     place_ids_to_want_to_taste_data = {}
-    for p in place_ids_to_data.keys():
-        place_ref = db.collection('places').document(p)
-        want_to_tastes = [w for w in queue_want_to_taste_ids_to_data.values() if w['place'] == place_ref.id]
-        want_to_taste_data = []
-        for w in want_to_tastes:
-            want_to_taste_data.append({
-                'id': w.get('id'),
-                'user': w.get('user'),
-                'place': w.get('place'),
-                'timestamp': w.get('timestamp')
-            })
-        place_ids_to_want_to_taste_data[p] = want_to_taste_data
+    for w in queue_want_to_taste_ids_to_data.values():
+        place_id = w['place']
+        if place_id not in place_ids_to_data:
+            continue
+        place_ids_to_want_to_taste_data.setdefault(place_id, []).append(w)
     return place_ids_to_want_to_taste_data
 
 # create 'UserPostedTaste' events whenever a user posts a taste
@@ -152,7 +210,7 @@ def create_events_for_user_posted_taste(post_ids_to_data, queue_post_ids_to_data
             'credsData': {
                 'placeName': place['name']
             },
-            'timestamp': datetime.datetime.strptime(timestamp.strftime("%Y-%m-%d %H:%M:%S"), '%Y-%m-%d %H:%M:%S')
+            'timestamp': from_micros(timestamp)
         })
     return events
 
@@ -162,29 +220,25 @@ def create_events_for_user_posted_taste(post_ids_to_data, queue_post_ids_to_data
 def create_events_for_user_tasted_place_first(place_ids_to_post_data, place_ids_to_queue_post_data, place_ids_to_data, user_ids_to_data):
     print('Creating events for users tasting place first...')
     events = []
-    for place_id, place_post_data in place_ids_to_post_data.items():
+    place_ids_to_first_post_data = _get_place_ids_to_first_post_data(place_ids_to_post_data)
+    for place_id in place_ids_to_post_data:
+        queue_post_data = place_ids_to_queue_post_data.get(place_id, [])
+        if len(queue_post_data) == 0:
+            continue
         place = place_ids_to_data[place_id]
+        first_post_data = place_ids_to_first_post_data[place_id]
+        user_ids_to_indexes = first_post_data['indexes']
 
-        # get sorted list of posts filtering out retastes
-        sorted_place_post_data = sorted(place_post_data, key=lambda p: p['timestamp'])
-        sanitized_place_post_data = []
-        for p in sorted_place_post_data:
-            if p['user'] in [p['user'] for p in sanitized_place_post_data]:
-                continue
-            sanitized_place_post_data.append(p)
-
-        queue_post_data = place_ids_to_queue_post_data.get(place_id, [])
         for queue_post in queue_post_data:
-            if queue_post not in sanitized_place_post_data:
+            index = _get_first_post_index(first_post_data, queue_post)
+            if index is None:
                 continue
             user = queue_post['user']
-            user_friend_ids = user_ids_to_data[user]['friends']
-            place_posts_filtered = [p for p in sanitized_place_post_data if p['user'] in user_friend_ids or p['user'] == user]
-            place_first_post_for_friends = place_posts_filtered[0]
-            timestamp = place_first_post_for_friends["timestamp"]
             # prevent creating event for same person in multiple friend graphs
-            if place_first_post_for_friends['user'] != user:
+            if any(user_ids_to_indexes.get(f, index) < index for f in user_ids_to_data[user]['friends']):
                 continue
+            place_first_post_for_friends = queue_post
+            timestamp = place_first_post_for_friends["timestamp"]
             events.append({
                 'type': 'UserTastedPlaceFirst',
                 'user': user,
@@ -194,7 +248,7 @@ def create_events_for_user_tasted_place_first(place_ids_to_post_data, place_ids_
                 'credsData': {
                     'placeName': place['name'],
                 },
-                'timestamp': datetime.datetime.strptime(timestamp.strftime("%Y-%m-%d %H:%M:%S"), '%Y-%m-%d %H:%M:%S')
+                'timestamp': from_micros(timestamp)
             })
     return events
 
@@ -205,20 +259,10 @@ def create_events_for_user_tasted_place_first(place_ids_to_post_data, place_ids_
 def create_events_for_friend_wants_to_taste_place_you_tasted(place_ids_to_post_data, place_ids_to_want_to_taste_data, place_ids_to_data, post_ids_to_data, user_ids_to_data):
     print('Creating events for friends wanting to taste places...')
     events = []
-    place_ids = set(place_ids_to_post_data.keys()) | set(place_ids_to_want_to_taste_data.keys())
-    for place_id in place_ids:
+    place_ids_to_first_post_data = _get_place_ids_to_first_post_data(place_ids_to_post_data, min_star_rating=3)
+    for place_id, place_want_to_taste_data in place_ids_to_want_to_taste_data.items():
         place = place_ids_to_data[place_id]
-        place_post_data = place_ids_to_post_data.get(place_id, [])
-        place_want_to_taste_data = place_ids_to_want_to_taste_data.get(place_id, [])
-
-        # get sorted list of posts filtering out star ratings less than 3 and retastes
-        sorted_place_post_data = sorted(place_post_data, key=lambda p: p['timestamp'])
-        filtered_place_post_data = [p for p in sorted_place_post_data if p['starRating'] >= 3]
-        sanitized_place_post_data = []
-        for p in filtered_place_post_data:
-            if p['user'] in [p['user'] for p in sanitized_place_post_data]:
-                continue
-            sanitized_place_post_data.append(p)
+        sanitized_place_post_data = place_ids_to_first_post_data.get(place_id, {'posts': []})['posts']
 
         for place_want_to_taste in place_want_to_taste_data:
             user_id = place_want_to_taste['user']
@@ -238,7 +282,7 @@ def create_events_for_friend_wants_to_taste_place_you_tasted(place_ids_to_post_d
                         'friendFirstName': user['firstName'],
                         'placeName': place['name']
                     },
-                    'timestamp': datetime.datetime.strptime(timestamp.strftime("%Y-%m-%d %H:%M:%S"), '%Y-%m-%d %H:%M:%S')
+                    'timestamp': from_micros(timestamp)
                 })
     return events
 
@@ -251,21 +295,18 @@ def create_events_for_friend_wants_to_taste_place_you_tasted(place_ids_to_post_d
 def create_events_for_friend_tasted_liked_place_you_tasted(place_ids_to_post_data, place_ids_to_queue_post_data, place_ids_to_data, user_ids_to_data):
     print('Creating events for friends tasting/liking places...')
     events = []
-    for place_id, place_post_data in place_ids_to_post_data.items():
+    place_ids_to_first_post_data = _get_place_ids_to_first_post_data(place_ids_to_post_data, min_star_rating=3)
+    for place_id in place_ids_to_post_data:
+        queue_post_data = place_ids_to_queue_post_data.get(place_id, [])
+        if len(queue_post_data) == 0:
+            continue
         place = place_ids_to_data[place_id]
+        first_post_data = place_ids_to_first_post_data[place_id]
+        sanitized_place_post_data = first_post_data['posts']
 
-        # get sorted list of posts filtering out star ratings less than 3 and retastes
-        sorted_place_post_data = sorted(place_post_data, key=lambda p: p['timestamp'])
-        filtered_place_post_data = [p for p in sorted_place_post_data if p['starRating'] >= 3]
-        sanitized_place_post_data = []
-        for p in filtered_place_post_data:
-            if p['user'] in [p['user'] for p in sanitized_place_post_data]:
-                continue
-            sanitized_place_post_data.append(p)
-
-        queue_post_data = place_ids_to_queue_post_data.get(place_id, [])
         for queue_post in queue_post_data:
-            if queue_post not in sanitized_place_post_data:
+            index = _get_first_post_index(first_post_data, queue_post)
+            if index is None:
                 continue
             post_id = queue_post['id']
             user_id = queue_post['user']
@@ -273,7 +314,6 @@ def create_events_for_friend_tasted_liked_place_you_tasted(place_ids_to_post_dat
             star_rating = queue_post['starRating']
             timestamp = queue_post['timestamp']
             friends = user_ids_to_data[user_id]['friends']
-            index = sanitized_place_post_data.index(queue_post)
             for i in range(index):
                 comp = sanitized_place_post_data[i]
                 comp_user_id = comp['user']
@@ -289,7 +329,7 @@ def create_events_for_friend_tasted_liked_place_you_tasted(place_ids_to_post_dat
                         'friendFirstName': user['firstName'],
                         'placeName': place['name']
                     },
-                    'timestamp': datetime.datetime.strptime(timestamp.strftime("%Y-%m-%d %H:%M:%S"), '%Y-%m-%d %H:%M:%S')
+                    'timestamp': from_micros(timestamp)
                 }
                 if star_rating == 5:
                     events.append({**{'type': 'FriendLikedPlaceYouTasted'}, **payload})
@@ -297,6 +337,51 @@ def create_events_for_friend_tasted_liked_place_you_tasted(place_ids_to_post_dat
                     events.append({**{'type': 'FriendTastedPlaceYouTasted'}, **payload})
     return events
 
+def _get_queue_post_indexes(snapshot, queue_post_ids_to_data):
+    posts = snapshot.posts
+    queue_post_ids = [d['postId'] for d in queue_post_ids_to_data.values()]
+    return np.array([posts.index(p) for p in queue_post_ids if p in posts], dtype=np.int64)
+
+# returns the events for everything in the queues along with the queues (with
+# the queued posts whose post was deleted, which get no events); when
+# backfilling, every post is treated as queued and the want to taste queue
+# (whose history is not kept) is left alone
+def generate_events(snapshot, backend='dict', backfill=False):
+    # cache raw data
+    user_ids_to_data = _get_user_ids_to_data(snapshot)
+    post_ids_to_data = _get_post_ids_to_data(snapshot)
+    place_ids_to_data = _get_place_ids_to_data(snapshot)
+
+    # get documents to process
+    deleted_queue_post_ids_to_data = {}
+    if backfill:
+        queue_post_ids_to_data = {p: {'postId': p} for p in post_ids_to_data}
+        queue_want_to_taste_ids_to_data = {}
+    else:
+        queue_post_ids_to_data, deleted_queue_post_ids_to_data = _get_ready_queue_post_ids_to_data(snapshot.db, _get_queue_post_ids_to_data(snapshot), post_ids_to_data)
+        queue_want_to_taste_ids_to_data = _get_queue_want_to_taste_ids_to_data(snapshot)
+
+    # create maps based on places
+    place_ids_to_post_data = _get_place_ids_to_post_data(post_ids_to_data)
+    place_ids_to_want_to_taste_data = _get_place_ids_to_want_to_taste_data(place_ids_to_data, queue_want_to_taste_ids_to_data)
+
+    # create events
+    events = []
+    if backend == 'columnar':
+        post_arrays = build_post_arrays(snapshot)
+        queue_posts = _get_queue_post_indexes(snapshot, queue_post_ids_to_data)
+        events.extend(create_events_for_user_posted_taste_columnar(post_arrays, queue_posts, place_ids_to_data))
+        events.extend(create_events_for_user_tasted_place_first_columnar(post_arrays, queue_posts, place_ids_to_data))
+        events.extend(create_events_for_friend_wants_to_taste_place_you_tasted(place_ids_to_post_data, place_ids_to_want_to_taste_data, place_ids_to_data, post_ids_to_data, user_ids_to_data))
+        events.extend(create_events_for_friend_tasted_liked_place_you_tasted_columnar(post_arrays, queue_posts, place_ids_to_data, user_ids_to_data))
+    else:
+        place_ids_to_queue_post_data = _get_place_ids_to_queue_post_data(post_ids_to_data, queue_post_ids_to_data)
+        events.extend(create_events_for_user_posted_taste(post_ids_to_data, queue_post_ids_to_data, place_ids_to_data))
+        events.extend(create_events_for_user_tasted_place_first(place_ids_to_post_data, place_ids_to_queue_post_data, place_ids_to_data, user_ids_to_data))
+        events.extend(create_events_for_friend_wants_to_taste_place_you_tasted(place_ids_to_post_data, place_ids_to_want_to_taste_data, place_ids_to_data, post_ids_to_data, user_ids_to_data))
+        events.extend(create_events_for_friend_tasted_liked_place_you_tasted(place_ids_to_post_data, place_ids_to_queue_post_data, place_ids_to_data, user_ids_to_data))
+    return events, {**queue_post_ids_to_data, **deleted_queue_post_ids_to_data}, queue_want_to_taste_ids_to_data
+
 def output_events(events):
     # save json
     with open('tmp/events.json', 'w') as f:
@@ -325,22 +410,66 @@ def output_events(events):
         writer.writerow(fields)
         writer.writerows(rows)
 
-def publish_events(db, events):
-    print('Publishing events...')
-    for event in events:
-        print('Creating event', event)
-        db.collection('events').add(event)
+def get_event_id(event):
+    key = json.dumps([event['type'], event['user'], event['data']], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+# maps each queue entry, as (collection, document ID), to the events generated
+# from it; an event generated from several duplicate entries goes to the first
+def _get_queue_entries_to_events(events, queue_post_ids_to_data, queue_want_to_taste_ids_to_data):
+    queue_entries_to_events = {}
+    post_ids_to_queue_entries = {}
+    for q, d in queue_post_ids_to_data.items():
+        queue_entries_to_events[('queueposts', q)] = []
+        post_ids_to_queue_entries.setdefault(d['postId'], []).append(('queueposts', q))
+    want_to_tastes_to_queue_entries = {}
+    for w, d in queue_want_to_taste_ids_to_data.items():
+        queue_entries_to_events[('queuewanttotastes', w)] = []
+        want_to_tastes_to_queue_entries.setdefault((d['user'], d['place']), []).append(('queuewanttotastes', w))
 
-def clear_queues(db, queue_post_ids_to_data, queue_want_to_taste_ids_to_data):
-    print('Clearing queues...')
-    for p in queue_post_ids_to_data:
-        db.collection('queueposts').document(p).delete()
-    for w in queue_want_to_taste_ids_to_data:
-        db.collection('queuewanttotastes').document(w).delete()
+    for e in events:
+        if e['type'] == 'FriendWantsToTastePlaceYouTasted':
+            queue_entries = want_to_tastes_to_queue_entries[(e['data']['user'], e['data']['place'])]
+        else:
+            queue_entries = post_ids_to_queue_entries[e['data']['post']]
+        queue_entries_to_events[queue_entries[0]].append(e)
+    return queue_entries_to_events
+
+def _get_existing_event_ids(db, events):
+    print('Getting existing events...')
+    event_refs = [db.collection('events').document(i) for i in sorted({get_event_id(e) for e in events})]
+    existing_event_ids = set()
+    for i in range(0, len(event_refs), _GET_ALL_CHUNK_SIZE):
+        for e in db.get_all(event_refs[i:i + _GET_ALL_CHUNK_SIZE], field_paths=['createdAt']):
+            if e.exists:
+                existing_event_ids.add(e.id)
+    return existing_event_ids
+
+def publish_events(db, events, queue_post_ids_to_data, queue_want_to_taste_ids_to_data, max_workers=8):
+    print('Publishing events...')
+    queue_entries_to_events = _get_queue_entries_to_events(events, queue_post_ids_to_data, queue_want_to_taste_ids_to_data)
+    existing_event_ids = _get_existing_event_ids(db, events)
+    with BatchWriter(db, 'events', max_workers=max_workers) as writer:
+        for (collection, queue_id), queue_events in queue_entries_to_events.items():
+            with writer.group():
+                for event in queue_events:
+                    event_id = get_event_id(event)
+                    if event_id in existing_event_ids:
+                        continue
+                    existing_event_ids.add(event_id)
+                    writer.set(db.collection('events').document(event_id), {
+                        **event,
+                        'createdAt': firestore.SERVER_TIMESTAMP
+                    })
+                writer.delete(db.collection(collection).document(queue_id))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--backend', type=str, choices=['dict', 'columnar'], default='dict')
+    parser.add_argument('--backfill', action='store_true')
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -357,27 +486,10 @@ if __name__ == '__main__':
 
     db = firestore.client()
 
-    # cache raw data
-    user_ids_to_data = _get_user_ids_to_data(db)
-    post_ids_to_data = _get_post_ids_to_data(db)
-    place_ids_to_data = _get_place_ids_to_data(db)
-
-    # get documents to process
-    queue_post_ids_to_data = _get_queue_post_ids_to_data(db, post_ids_to_data)
-    queue_want_to_taste_ids_to_data = _get_queue_want_to_taste_ids_to_data(db)
-
-    # create maps based on places
-    place_ids_to_post_data = _get_place_ids_to_post_data(post_ids_to_data)
-    place_ids_to_queue_post_data = _get_place_ids_to_queue_post_data(post_ids_to_data, queue_post_ids_to_data)
-    place_ids_to_want_to_taste_data = _get_place_ids_to_want_to_taste_data(place_ids_to_data, queue_want_to_taste_ids_to_data)
-
-    # create events
-    events = []
-    events.extend(create_events_for_user_posted_taste(post_ids_to_data, queue_post_ids_to_data, place_ids_to_data))
-    events.extend(create_events_for_user_tasted_place_first(place_ids_to_post_data, place_ids_to_queue_post_data, place_ids_to_data, user_ids_to_data))
-    events.extend(create_events_for_friend_wants_to_taste_place_you_tasted(place_ids_to_post_data, place_ids_to_want_to_taste_data, place_ids_to_data, post_ids_to_data, user_ids_to_data))
-    events.extend(create_events_for_friend_tasted_liked_place_you_tasted(place_ids_to_post_data, place_ids_to_queue_post_data, place_ids_to_data, user_ids_to_data))
-
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    events, queue_post_ids_to_data, queue_want_to_taste_ids_to_data = generate_events(snapshot, args.backend, args.backfill)
     output_events(events)
-    publish_events(db, events)
-    clear_queues(db, queue_post_ids_to_data, queue_want_to_taste_ids_to_data)
+    # backfilled events are only written to tmp/ for review
+    if args.backfill:
+        exit(0)
+    publish_events(db, events, queue_post_ids_to_data, queue_want_to_taste_ids_to_data, args.max_workers)
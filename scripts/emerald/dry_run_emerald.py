@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import firebase_admin
+import json
+import os
+import sys
+import time
+from collections import Counter
+from firebase_admin import credentials, firestore
+from os import environ
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from calculate_emerald_creds import EVENT_TYPES_TO_CREDS, build_cred_ledger, get_emerald_status_changes
+from create_emerald_events import generate_events, get_event_id
+from lib.leaderboard import get_top_user_ids
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+
+'''
+Runs create_emerald_events and calculate_emerald_creds on a snapshot without
+writing anything or prompting, and prints what a real run would change: the
+events it would publish, the cred changes, who would gain or lose Emerald and
+how many notifications would go out, along with the time each phase took.
+'''
+
+def _get_user_ids_to_data(snapshot):
+    users = snapshot.users
+    user_ids_to_data = {}
+    for i, u in enumerate(users.ids):
+        user_ids_to_data[u] = {
+            'handle': users['handle'][i],
+            'emerald': bool(users['emerald'][i]),
+            'emeraldCreds': users['emeraldCreds'][i],
+            'friends': users['friends'][i]
+        }
+    return user_ids_to_data
+
+def _timed(phases_to_seconds, phase, f, *args):
+    start = time.monotonic()
+    result = f(*args)
+    phases_to_seconds[phase] = time.monotonic() - start
+    return result
+
+# events the publisher would write, skipping ones that already exist
+def _get_new_events(snapshot, events):
+    existing_event_ids = set(snapshot.table('events').ids)
+    new_events = []
+    for e in events:
+        event_id = get_event_id(e)
+        if event_id in existing_event_ids:
+            continue
+        existing_event_ids.add(event_id)
+        new_events.append(e)
+    return new_events
+
+def _calculate_creds(snapshot, user_ids_to_data, new_events):
+    ledger = build_cred_ledger(snapshot)
+    for e in new_events:
+        ledger['creds'][e['user']] = ledger['creds'].get(e['user'], 0) + EVENT_TYPES_TO_CREDS[e['type']]
+    return {u: ledger['creds'].get(u, 0) for u in user_ids_to_data}
+
+def calculate_dry_run(snapshot):
+    phases_to_seconds = {}
+    user_ids_to_data = _timed(phases_to_seconds, 'load users', _get_user_ids_to_data, snapshot)
+    events, queue_post_ids_to_data, queue_want_to_taste_ids_to_data = _timed(phases_to_seconds, 'generate events', generate_events, snapshot)
+    new_events = _timed(phases_to_seconds, 'deduplicate events', _get_new_events, snapshot, events)
+    user_ids_to_creds = _timed(phases_to_seconds, 'calculate creds', _calculate_creds, snapshot, user_ids_to_data, new_events)
+    emerald_user_ids = _timed(phases_to_seconds, 'rank users', get_top_user_ids, user_ids_to_creds)
+
+    current_emerald_user_ids = [u for u, d in user_ids_to_data.items() if d['emerald']]
+    remove_emerald_user_ids, award_emerald_user_ids = get_emerald_status_changes(current_emerald_user_ids, emerald_user_ids)
+    notification_counts = Counter({
+        'YouLostTasteEmerald': len(remove_emerald_user_ids),
+        'YouWereAwardedTasteEmerald': len(award_emerald_user_ids),
+        'FriendWasAwardedTasteEmerald': sum(len(user_ids_to_data[u]['friends']) for u in award_emerald_user_ids)
+    })
+    cred_changes = {}
+    for u, creds in user_ids_to_creds.items():
+        if creds != user_ids_to_data[u]['emeraldCreds']:
+            cred_changes[user_ids_to_data[u]['handle']] = [user_ids_to_data[u]['emeraldCreds'], creds]
+    return {
+        'queuedPosts': len(queue_post_ids_to_data),
+        'queuedWantToTastes': len(queue_want_to_taste_ids_to_data),
+        'newEvents': dict(Counter(e['type'] for e in new_events)),
+        'credChanges': cred_changes,
+        'emeraldGains': sorted(user_ids_to_data[u]['handle'] for u in award_emerald_user_ids),
+        'emeraldLosses': sorted(user_ids_to_data[u]['handle'] for u in remove_emerald_user_ids),
+        'notifications': dict(notification_counts),
+        'timing': phases_to_seconds
+    }
+
+def print_dry_run(diff):
+    print(f'Queues: {diff["queuedPosts"]} posts, {diff["queuedWantToTastes"]} want to tastes')
+    print(f'New events: {sum(diff["newEvents"].values())} {diff["newEvents"]}')
+    print(f'Cred changes: {len(diff["credChanges"])} users')
+    for handle, (old_creds, new_creds) in sorted(diff['credChanges'].items(), key=lambda t: t[1][1] - t[1][0], reverse=True):
+        print(f'  {handle}: {old_creds} -> {new_creds} ({new_creds - old_creds:+d})')
+    print(f'Emerald gains: {diff["emeraldGains"]}')
+    print(f'Emerald losses: {diff["emeraldLosses"]}')
+    print(f'Notifications: {sum(diff["notifications"].values())} {diff["notifications"]}')
+    print('Timing:')
+    for phase, seconds in diff['timing'].items():
+        print(f'  {phase}: {seconds:.2f}s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--output-path', type=str, required=False)
+    add_snapshot_arguments(parser)
+    args = parser.parse_args()
+
+    token_dict = None
+    with open(args.cert_path, 'r') as f:
+        token_dict = json.load(f)
+
+    credentials = credentials.Certificate(token_dict)
+    firebase_admin.initialize_app(credentials)
+
+    if not 'FIRESTORE_EMULATOR_HOST' in environ and 'BYPASS_FIREBASE_PRODUCTION_PROMPT' not in environ:
+        confirm = input('WARNING: connected to production, type "y" to continue: ')
+        if confirm != "y":
+            exit(0)
+
+    db = firestore.client()
+
+    start = time.monotonic()
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    for collection in ['users', 'posts', 'places', 'events', 'queueposts', 'queuewanttotastes']:
+        snapshot.table(collection)
+    load_seconds = time.monotonic() - start
+
+    diff = calculate_dry_run(snapshot)
+    diff['timing'] = {'load snapshot': load_seconds, **diff['timing']}
+    print_dry_run(diff)
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(diff, f, indent=2)
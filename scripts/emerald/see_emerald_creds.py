@@ -4,60 +4,94 @@ import csv
 import datetime
 import firebase_admin
 import json
+import os
 import pytz
+import sys
 from firebase_admin import credentials, firestore
 from os import environ
 
-def _get_user_ids_to_data(db):
-    print('Getting users...')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.leaderboard import get_latest_rank_snapshot, get_rank_changes, load_rank_history, rank_user_ids
+from lib.place_refs import get_place_ids_to_refs, load_place_refs, refresh_place_refs, save_place_refs
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+
+_GET_ALL_CHUNK_SIZE = 300
+
+def _get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    users = db.collection('users').stream()
-    for u in users:
-        user_dict = u.to_dict()
-        user_ids_to_data[u.id] = {
-            'id': u.id,
-            'firstName': user_dict.get('firstName'),
-            'lastName': user_dict.get('lastName'),
-            'handle': user_dict.get('handle'),
-            'wantToTaste': [p.id for p in user_dict.get('wantToTaste')],
-            'friends': [f.id for f in user_dict.get('friends')]
+    for u, d in snapshot.users.rows():
+        user_ids_to_data[u] = {
+            'id': u,
+            'firstName': d['firstName'],
+            'lastName': d['lastName'],
+            'handle': d['handle'],
+            'wantToTaste': list(d['wantToTaste']),
+            'friends': list(d['friends'])
         }
     return user_ids_to_data
 
-def _get_place_ids_to_data(db):
-    print('Getting places...')
-    place_ids_to_data = {}
-    places = db.collection('places').stream()
-    for p in places:
-        place_dict = p.to_dict()
-        place_ids_to_data[p.id] = {
-            'id': p.id,
-            'name': place_dict.get('name')
-        }
-    return place_ids_to_data
+def _get_event_ids_to_data(snapshot):
+    event_ids_to_data = {}
+    for e, d in snapshot.table('events').rows():
+        event_ids_to_data[e] = d
+    return event_ids_to_data
 
-def _get_post_ids_to_data(db):
-    print('Getting posts...')
-    post_ids_to_data = {}
-    posts = db.collection('posts').stream()
-    for p in posts:
-        post_data = p.to_dict()
-        post_ids_to_data[p.id] = {
-            'user': post_data.get('user').id,
-            'place': post_data.get('place').id,
-            'starRating': post_data.get('starRating'),
-            'timestamp': post_data.get('timestamp')
+def _get_all(db, collection, ids, field_paths):
+    refs = [db.collection(collection).document(i) for i in sorted(ids)]
+    ids_to_data = {}
+    for i in range(0, len(refs), _GET_ALL_CHUNK_SIZE):
+        for d in db.get_all(refs[i:i + _GET_ALL_CHUNK_SIZE], field_paths=field_paths):
+            if d.exists:
+                ids_to_data[d.id] = d.to_dict()
+    return ids_to_data
+
+# loads only what explaining one user's creds needs: the user found by handle,
+# their events and the posts, places and friends those events reference
+def get_user_cred_data(db, handle):
+    print(f'Getting user "{handle}"...')
+    user_ids_to_data = {}
+    for u in db.collection('users').where('handle', '==', handle).get():
+        user_ids_to_data[u.id] = {
+            'id': u.id,
+            'handle': u.get('handle')
         }
-    return post_ids_to_data
+    if len(user_ids_to_data) != 1:
+        return user_ids_to_data, {}, {}, {}
 
-def _get_event_ids_to_data(db):
     print('Getting events...')
+    user_id = list(user_ids_to_data.keys())[0]
     event_ids_to_data = {}
-    events = db.collection('events').stream()
-    for e in events:
-        event_dict = e.to_dict()
-        event_ids_to_data[e.id] = event_dict
-    return event_ids_to_data
+    for e in db.collection('events').where('user', '==', user_id).stream():
+        event_ids_to_data[e.id] = e.to_dict()
+
+    print('Getting referenced posts...')
+    post_ids = {e['data']['post'] for e in event_ids_to_data.values() if 'post' in e['data']}
+    post_ids_to_data = {}
+    for p, d in _get_all(db, 'posts', post_ids, ['user', 'place']).items():
+        post_ids_to_data[p] = {
+            'user': d['user'].id,
+            'place': d['place'].id
+        }
+
+    print('Getting referenced places and friends...')
+    place_ids = {p['place'] for p in post_ids_to_data.values()}
+    friend_ids = {p['user'] for p in post_ids_to_data.values()}
+    for e in event_ids_to_data.values():
+        if e['type'] == 'FriendWantsToTastePlaceYouTasted':
+            place_ids.add(e['data']['place'])
+            friend_ids.add(e['data']['user'])
+    place_ids_to_data = {}
+    for p, d in _get_all(db, 'places', place_ids, ['name']).items():
+        place_ids_to_data[p] = {
+            'id': p,
+            'name': d['name']
+        }
+    for u, d in _get_all(db, 'users', friend_ids - {user_id}, ['handle']).items():
+        user_ids_to_data[u] = {
+            'id': u,
+            'handle': d['handle']
+        }
+    return user_ids_to_data, place_ids_to_data, post_ids_to_data, event_ids_to_data
 
 def see_user_creds(user_ids_to_data, place_ids_to_data, post_ids_to_data, event_ids_to_data, event_type_to_creds, handle):
     print(f'Getting user creds for "{handle}"...')
@@ -114,22 +148,60 @@ def see_user_creds(user_ids_to_data, place_ids_to_data, post_ids_to_data, event_
             print(f'Awarding {creds} creds for getting friend "{friend["handle"]}" to like "{place["name"]}"...')
     print(f'Total creds: {total_creds}')
 
-def get_user_ids_to_creds_tuples(user_ids_to_data, event_ids_to_data, event_type_to_creds):
-    user_ids_to_creds_tuples = []
-    for u in user_ids_to_data:
-        print(f'Processing user {u}...')
-        creds = 0
-        events = [e for _, e in event_ids_to_data.items() if e['user'] == u]
-        for event in events:
-            event_type = event['type']
-            creds += event_type_to_creds[event_type]
-        user_ids_to_creds_tuples.append((u, creds))
-    return user_ids_to_creds_tuples
+def get_user_ids_to_creds(user_ids_to_data, event_ids_to_data, event_type_to_creds):
+    user_ids_to_creds = {u: 0 for u in user_ids_to_data}
+    for e in event_ids_to_data.values():
+        if e['user'] in user_ids_to_creds:
+            user_ids_to_creds[e['user']] += event_type_to_creds[e['type']]
+    return user_ids_to_creds
+
+# shows the creds earned at a place, through events that reference it or one
+# of its posts, as merging or deleting the place would affect them
+def see_place_creds(user_ids_to_data, event_ids_to_data, place_ids_to_refs, event_type_to_creds, place_id):
+    place_refs = place_ids_to_refs.get(place_id, {})
+    post_ids = set(place_refs.get('posts.place', []))
+    event_ids = set(place_refs.get('events.data.place', []))
+    event_ids.update(e for e, d in event_ids_to_data.items() if (d['data'] or {}).get('post') in post_ids)
+    print(f'Place {place_id} has {len(post_ids)} posts and {len(event_ids)} events...')
+    user_ids_to_creds = {}
+    for e in event_ids:
+        event = event_ids_to_data[e]
+        user_ids_to_creds[event['user']] = user_ids_to_creds.get(event['user'], 0) + event_type_to_creds[event['type']]
+    for u in sorted(user_ids_to_creds.keys(), key=lambda u: user_ids_to_creds[u], reverse=True):
+        handle = user_ids_to_data[u]['handle'] if u in user_ids_to_data else u
+        print(f'{handle} - {user_ids_to_creds[u]}')
+    print(f'Total creds: {sum(user_ids_to_creds.values())}')
+
+def see_leaderboard(user_ids_to_data, rank_history):
+    date, user_ids_to_creds = get_latest_rank_snapshot(rank_history)
+    if date is None:
+        print('ERROR: no rank snapshots recorded yet')
+        exit(1)
+    top_user_ids = list(user_ids_to_creds.keys())
+    print(f'Leaderboard on {date}:')
+    for rank, u, creds in rank_user_ids(top_user_ids, user_ids_to_creds):
+        print(f'{rank}. {user_ids_to_data[u]["handle"]} - {creds}')
+
+    previous_date, previous_user_ids_to_creds = get_latest_rank_snapshot(rank_history, datetime.date.fromisoformat(date))
+    if previous_date is None:
+        return
+    entered, left, moved = get_rank_changes(list(previous_user_ids_to_creds.keys()), previous_user_ids_to_creds, top_user_ids, user_ids_to_creds)
+    print(f'Changes since {previous_date}:')
+    for u in entered:
+        print(f'  {user_ids_to_data[u]["handle"]} entered the top')
+    for u in left:
+        print(f'  {user_ids_to_data[u]["handle"]} left the top')
+    for u, previous_rank, rank in moved:
+        print(f'  {user_ids_to_data[u]["handle"]} moved from {previous_rank} to {rank}')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
     parser.add_argument('--user-handle', type=str, required=False)
+    parser.add_argument('--rank-history-path', type=str, required=False)
+    parser.add_argument('--place-id', type=str, required=False)
+    parser.add_argument('--place-refs-path', type=str, required=False)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -146,11 +218,6 @@ if __name__ == '__main__':
 
     db = firestore.client()
 
-    user_ids_to_data = _get_user_ids_to_data(db)
-    place_ids_to_data = _get_place_ids_to_data(db)
-    post_ids_to_data = _get_post_ids_to_data(db)
-    event_ids_to_data = _get_event_ids_to_data(db)
-
     event_type_to_creds = {
         'UserPostedTaste': 1,
         'UserTastedPlaceFirst': 2,
@@ -159,11 +226,25 @@ if __name__ == '__main__':
         'FriendLikedPlaceYouTasted': 5
     }
     if args.user_handle:
+        user_ids_to_data, place_ids_to_data, post_ids_to_data, event_ids_to_data = get_user_cred_data(db, args.user_handle)
         see_user_creds(user_ids_to_data, place_ids_to_data, post_ids_to_data, event_ids_to_data, event_type_to_creds, args.user_handle)
+        exit(0)
+
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = _get_user_ids_to_data(snapshot)
+    if args.place_id:
+        if not args.place_refs_path:
+            print('ERROR: --place-id requires --place-refs-path')
+            exit(1)
+        place_refs = load_place_refs(args.place_refs_path)
+        refresh_place_refs(place_refs, snapshot)
+        save_place_refs(args.place_refs_path, place_refs)
+        see_place_creds(user_ids_to_data, _get_event_ids_to_data(snapshot), get_place_ids_to_refs(place_refs), event_type_to_creds, args.place_id)
+    elif args.rank_history_path:
+        see_leaderboard(user_ids_to_data, load_rank_history(args.rank_history_path))
     else:
-        user_ids_to_creds_tuples = get_user_ids_to_creds_tuples(user_ids_to_data, event_ids_to_data, event_type_to_creds)
-        user_ids_to_creds_tuples = sorted(user_ids_to_creds_tuples, key=lambda t: t[1], reverse=True)
-        for i in range(0, len(user_ids_to_creds_tuples)):
-            user_id_to_creds_tuple = user_ids_to_creds_tuples[i]
-            user = user_ids_to_data[user_id_to_creds_tuple[0]]
-            print(f'{i + 1}. {user["handle"]} - {user_id_to_creds_tuple[1]}')
+        event_ids_to_data = _get_event_ids_to_data(snapshot)
+        user_ids_to_creds = get_user_ids_to_creds(user_ids_to_data, event_ids_to_data, event_type_to_creds)
+        user_ids = sorted(user_ids_to_creds.keys(), key=lambda u: user_ids_to_creds[u], reverse=True)
+        for i, u in enumerate(user_ids):
+            print(f'{i + 1}. {user_ids_to_data[u]["handle"]} - {user_ids_to_creds[u]}')
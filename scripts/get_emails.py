@@ -4,25 +4,23 @@ import csv
 import firebase_admin
 import json
 from firebase_admin import auth, credentials, firestore
+from lib.auth_users import get_user_ids_to_auth_timestamps
+from lib.snapshot import add_snapshot_arguments, load_snapshot
 from os import environ
 
-def get_user_ids_to_data(db):
-    print('Getting authenticated users...')
+def get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    for u in auth.list_users().iterate_all():
-        auth_user = auth.get_user(u.uid)
-        users = db.collection('users').where('phoneNumber', '==', u.phone_number).get()
-        if len(users) != 1:
-            continue
-        user = users[0]
-        user_ids_to_data[user.id] = {
-            'email': user.get('email'),
+    for u in get_user_ids_to_auth_timestamps(snapshot):
+        user = snapshot.users.get(u)
+        user_ids_to_data[u] = {
+            'email': user['email'],
         }
     return user_ids_to_data
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -34,7 +32,8 @@ if __name__ == '__main__':
 
     db = firestore.client()
 
-    user_ids_to_data = get_user_ids_to_data(db)
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = get_user_ids_to_data(snapshot)
     emails = [d['email'] for _, d in user_ids_to_data.items() if len(d['email']) > 0]
     for e in emails:
         print(e)
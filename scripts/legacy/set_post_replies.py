@@ -3,15 +3,27 @@ import argparse
 import csv
 import firebase_admin
 import json
+import os
+import sys
 from firebase_admin import credentials, firestore
 from os import environ
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.replies import get_reply_post_id, stream_replies
+
+def get_post_ids_to_reply_owner_refs(db):
+    print('Getting replies...')
+    post_ids_to_reply_owner_refs = {}
+    for r in stream_replies(db):
+        post_ids_to_reply_owner_refs.setdefault(get_reply_post_id(r), []).append(r.get('owner'))
+    return post_ids_to_reply_owner_refs
+
 def set_post_replies(db):
+    post_ids_to_reply_owner_refs = get_post_ids_to_reply_owner_refs(db)
     posts = db.collection('posts').stream()
     for p in posts:
         current_reply_owner_refs = p.to_dict().get('replyOwnerRefs', [])
-        replies = db.collection('posts').document(p.id).collection('replies').get()
-        new_reply_owner_refs = [r.get('owner') for r in replies]
+        new_reply_owner_refs = post_ids_to_reply_owner_refs.get(p.id, [])
         if len(new_reply_owner_refs) == 0 or set(current_reply_owner_refs) == set(new_reply_owner_refs):
             continue
         print(f'Setting reply owners on post "{p.id}"...')
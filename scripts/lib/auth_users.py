@@ -0,0 +1,42 @@
+import datetime
+from firebase_admin import auth
+
+'''
+Firebase Auth users joined to their `users` documents by phone number. Auth
+users are listed a page (up to 1000 users) at a time; the listed records
+already carry their metadata so no per-user lookup is needed, and the join
+against the users table of a snapshot happens in memory.
+'''
+
+_PAGE_SIZE = 1000
+
+def stream_auth_users():
+    page = auth.list_users(max_results=_PAGE_SIZE)
+    while page:
+        for u in page.users:
+            creation_timestamp = u.user_metadata.creation_timestamp
+            yield u.uid, {
+                'phoneNumber': u.phone_number,
+                'creationTimestamp': None if creation_timestamp is None else datetime.datetime.fromtimestamp(creation_timestamp / 1000, tz=datetime.timezone.utc)
+            }
+        page = page.get_next_page()
+
+# maps the IDs of users documents to the creation time of their Auth user in
+# epoch microseconds, skipping Auth users whose phone number matches no or
+# several users documents
+def get_user_ids_to_auth_timestamps(snapshot):
+    print('Joining authenticated users...')
+    phone_numbers_to_user_ids = {}
+    users = snapshot.users
+    for i, phone_number in enumerate(users['phoneNumber']):
+        phone_numbers_to_user_ids.setdefault(phone_number, []).append(users.ids[i])
+
+    auth_users = snapshot.table('auth')
+    user_ids_to_auth_timestamps = {}
+    creation_timestamps = auth_users['creationTimestamp']
+    for i, phone_number in enumerate(auth_users['phoneNumber']):
+        user_ids = phone_numbers_to_user_ids.get(phone_number, [])
+        if len(user_ids) != 1:
+            continue
+        user_ids_to_auth_timestamps[user_ids[0]] = creation_timestamps[i]
+    return user_ids_to_auth_timestamps
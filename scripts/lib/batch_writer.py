@@ -0,0 +1,174 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from google.api_core import exceptions
+
+'''
+Groups writes into Firestore batched writes (at most 500 operations each) and
+commits them from a bounded pool of worker threads. Queuing a write blocks
+once max_in_flight batches are waiting to commit so memory stays bounded.
+Batches that fail with a transient error are retried with exponential backoff;
+a batch is all-or-nothing, so retrying it never applies a write twice.
+
+Writes queued inside `with writer.group():` always land in the same batch so
+they are applied together. A group too large for one batch is committed as
+consecutive batches in the order its writes were queued.
+'''
+
+MAX_BATCH_SIZE = 500
+
+_RETRYABLE_EXCEPTIONS = (
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+)
+
+class BatchWriter:
+    def __init__(self, db, name='writes', batch_size=MAX_BATCH_SIZE, max_workers=8, max_in_flight=16, max_retries=5):
+        self.db = db
+        self.name = name
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.grouped = None
+        self.futures = []
+        self.num_batches = 0
+        self.num_writes = 0
+        self.num_retries = 0
+        self.latencies = []
+        self.errors = []
+        self.start_time = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set(self, ref, data, merge=False):
+        self._add(('set', ref, data, {'merge': merge}))
+
+    def create(self, ref, data):
+        self._add(('create', ref, data, {}))
+
+    def update(self, ref, data, option=None):
+        self._add(('update', ref, data, {} if option is None else {'option': option}))
+
+    def delete(self, ref):
+        self._add(('delete', ref, None, {}))
+
+    @contextmanager
+    def group(self):
+        if self.grouped is not None:
+            raise RuntimeError('groups cannot be nested')
+        self.grouped = []
+        try:
+            yield self
+            ops = self.grouped
+        finally:
+            self.grouped = None
+        if len(self.pending) + len(ops) > self.batch_size:
+            self._submit()
+        if len(ops) > self.batch_size:
+            chunks = [ops[i:i + self.batch_size] for i in range(0, len(ops), self.batch_size)]
+            self._submit_chunks(chunks)
+            return
+        self.pending.extend(ops)
+        if len(self.pending) >= self.batch_size:
+            self._submit()
+
+    def _add(self, op):
+        if self.grouped is not None:
+            self.grouped.append(op)
+            return
+        self.pending.append(op)
+        if len(self.pending) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if len(self.pending) == 0:
+            return
+        ops = self.pending
+        self.pending = []
+        self._submit_chunks([ops])
+
+    def _submit_chunks(self, chunks):
+        numbers = list(range(self.num_batches + 1, self.num_batches + len(chunks) + 1))
+        self.num_batches += len(chunks)
+        self.in_flight.acquire()
+        future = self.executor.submit(self._commit_chunks, numbers, chunks)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    # commits the chunks one after another, stopping at the first that fails
+    def _commit_chunks(self, numbers, chunks):
+        for number, ops in zip(numbers, chunks):
+            if not self._commit(number, ops):
+                return
+
+    def _commit(self, number, ops):
+        for attempt in range(self.max_retries + 1):
+            batch = self.db.batch()
+            for method, ref, data, kwargs in ops:
+                if method == 'delete':
+                    batch.delete(ref)
+                else:
+                    getattr(batch, method)(ref, data, **kwargs)
+            start = time.monotonic()
+            try:
+                batch.commit()
+            except _RETRYABLE_EXCEPTIONS as e:
+                if attempt == self.max_retries:
+                    self._fail(number, e)
+                    return False
+                with self.lock:
+                    self.num_retries += 1
+                delay = min(2 ** attempt, 32) + random.random()
+                print(f'WARNING: {self.name} batch {number} failed with {type(e).__name__}, retrying in {delay:.1f}s...')
+                time.sleep(delay)
+                continue
+            except Exception as e:
+                self._fail(number, e)
+                return False
+            latency = time.monotonic() - start
+            with self.lock:
+                self.num_writes += len(ops)
+                self.latencies.append(latency)
+            print(f'Committed {self.name} batch {number} of {len(ops)} writes in {latency:.2f}s...')
+            return True
+
+    def _fail(self, number, e):
+        print(f'ERROR: {self.name} batch {number} failed with {type(e).__name__}: {e}')
+        with self.lock:
+            self.errors.append((number, e))
+
+    def flush(self):
+        self._submit()
+        for f in self.futures:
+            f.result()
+        self.futures = []
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        self.report()
+        if len(self.errors) > 0:
+            raise RuntimeError(f'{len(self.errors)} {self.name} batches failed to commit')
+
+    def report(self):
+        elapsed = time.monotonic() - self.start_time
+        latencies = sorted(self.latencies)
+        summary = f'Committed {self.num_writes} {self.name} in {len(latencies)} batches over {elapsed:.2f}s'
+        if len(latencies) > 0:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            summary += f' (batch latency p50 {p50:.2f}s, p95 {p95:.2f}s, max {latencies[-1]:.2f}s)'
+        summary += f', {self.num_retries} retries, {len(self.errors)} failed batches'
+        print(summary)
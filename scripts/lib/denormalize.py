@@ -0,0 +1,100 @@
+from collections import namedtuple
+from lib.batch_writer import BatchWriter
+
+'''
+Derived fields are declared rather than hand-written as their own scan and
+patch script. A derived field names the collection and field it sets, its
+sources and a reduce function:
+
+GroupSource(collection, column)     documents of collection whose column is the
+                                    ID of the target document (e.g. the posts
+                                    of a place), passed as a list of rows
+RefSource(collection, column)       the document of collection whose ID is the
+                                    target's column (e.g. the place of a post),
+                                    passed as a row or None
+
+reduce(row, *sources) returns the field's value or SKIP to leave the document
+alone. calculate_patches reads every table of a snapshot at most once for all
+fields and keeps only the values that differ from the stored ones, so each
+changed document gets a single update carrying all of its changed fields.
+Collections are computed in the order their first field is declared, and
+sources see the derived values of collections computed before them.
+'''
+
+SKIP = object()
+
+GroupSource = namedtuple('GroupSource', ['collection', 'column'])
+RefSource = namedtuple('RefSource', ['collection', 'column'])
+DerivedField = namedtuple('DerivedField', ['collection', 'field', 'sources', 'reduce', 'equal', 'encode'], defaults=[None, None])
+
+def _equal(current_value, value):
+    return current_value == value
+
+def get_derived_field_name(derived_field):
+    return f'{derived_field.collection}.{derived_field.field}'
+
+class _Sources:
+    def __init__(self, snapshot, patches):
+        self.snapshot = snapshot
+        self.patches = patches
+        self.collections_to_rows = {}
+        self.groups = {}
+
+    def rows(self, collection):
+        if collection not in self.collections_to_rows:
+            collection_patches = self.patches.get(collection, {})
+            self.collections_to_rows[collection] = {
+                doc_id: {**row, **collection_patches.get(doc_id, {})} for doc_id, row in self.snapshot.table(collection).rows()
+            }
+        return self.collections_to_rows[collection]
+
+    def group(self, source):
+        if source not in self.groups:
+            rows = self.rows(source.collection)
+            self.groups[source] = {
+                value: [rows[doc_id] for doc_id in doc_ids] for value, doc_ids in self.snapshot.table(source.collection).group_by(source.column).items()
+            }
+        return self.groups[source]
+
+    def get(self, source, row, doc_id):
+        if isinstance(source, GroupSource):
+            return self.group(source).get(doc_id, [])
+        return self.rows(source.collection).get(row[source.column])
+
+# returns collection -> document ID -> field -> value for every derived value
+# that differs from the stored one
+def calculate_patches(snapshot, derived_fields):
+    patches = {}
+    sources = _Sources(snapshot, patches)
+    collections = []
+    for f in derived_fields:
+        if f.collection not in collections:
+            collections.append(f.collection)
+
+    for collection in collections:
+        fields = [f for f in derived_fields if f.collection == collection]
+        print(f'Calculating {", ".join(get_derived_field_name(f) for f in fields)}...')
+        collection_patches = patches.setdefault(collection, {})
+        for doc_id, row in snapshot.table(collection).rows():
+            for f in fields:
+                value = f.reduce(row, *[sources.get(s, row, doc_id) for s in f.sources])
+                if value is SKIP:
+                    continue
+                equal = f.equal or _equal
+                if equal(row[f.field], value):
+                    continue
+                collection_patches.setdefault(doc_id, {})[f.field] = value
+    return patches
+
+def write_patches(db, patches, derived_fields, max_workers=8):
+    fields_to_encoders = {(f.collection, f.field): f.encode for f in derived_fields if f.encode is not None}
+    for collection, collection_patches in patches.items():
+        print(f'Patching {len(collection_patches)} {collection}...')
+        with BatchWriter(db, collection, max_workers=max_workers) as writer:
+            for doc_id, patch in collection_patches.items():
+                print(f'Updating {", ".join(sorted(patch))} on {collection}/{doc_id}...')
+                encoded_patch = {}
+                for field, value in patch.items():
+                    encode = fields_to_encoders.get((collection, field))
+                    encoded_patch[field] = encode(db, value) if encode else value
+                writer.update(db.collection(collection).document(doc_id), encoded_patch)
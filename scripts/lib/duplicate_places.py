@@ -0,0 +1,185 @@
+import math
+import re
+import unicodedata
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+'''
+Finds places that are likely the same place added twice. Names and addresses
+are normalized (case, accents, punctuation and common street abbreviations)
+and places are blocked by the geohash cell of their coordinates: a place is
+compared with the places in its cell and the 8 cells around it, so a nearby
+duplicate that falls just across a cell edge is still found. Places with the
+same normalized address are also compared, whether or not they have
+coordinates and however far apart they were geocoded. Pairs are scored by the
+average string similarity of their names and addresses (zero when their
+street numbers differ), and pairs scoring at least the threshold are joined
+into groups.
+
+Geohash precision   Cell size (approx.)
+
+6                   1.2 km x 0.6 km
+7                   153 m x 153 m
+8                   38 m x 19 m
+'''
+
+DEFAULT_GEOHASH_PRECISION = 7
+DEFAULT_THRESHOLD = 0.85
+
+Place = namedtuple('Place', ['id', 'name', 'address', 'latitude', 'longitude', 'posts_count'])
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+_ADDRESS_ABBREVIATIONS = {
+    'avenue': 'ave',
+    'boulevard': 'blvd',
+    'court': 'ct',
+    'drive': 'dr',
+    'east': 'e',
+    'highway': 'hwy',
+    'lane': 'ln',
+    'north': 'n',
+    'place': 'pl',
+    'road': 'rd',
+    'south': 's',
+    'square': 'sq',
+    'street': 'st',
+    'suite': 'ste',
+    'west': 'w',
+}
+
+def _normalize(value):
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c)).lower()
+    value = value.replace('&', ' and ')
+    return re.sub(r'[^a-z0-9]+', ' ', value).split()
+
+def normalize_name(name):
+    return ' '.join(w for w in _normalize(name) if w != 'the')
+
+def normalize_address(address):
+    return ' '.join(_ADDRESS_ABBREVIATIONS.get(w, w) for w in _normalize(address))
+
+def encode_geohash(latitude, longitude, precision=DEFAULT_GEOHASH_PRECISION):
+    latitude_range = [-90.0, 90.0]
+    longitude_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    num_bits = 0
+    is_longitude = True
+    while len(geohash) < precision:
+        value, value_range = (longitude, longitude_range) if is_longitude else (latitude, latitude_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        is_longitude = not is_longitude
+        num_bits += 1
+        if num_bits == 5:
+            geohash.append(_GEOHASH_BASE32[bits])
+            bits = 0
+            num_bits = 0
+    return ''.join(geohash)
+
+# returns the cell of the coordinates and the 8 cells around it
+def get_geohash_neighborhood(latitude, longitude, precision=DEFAULT_GEOHASH_PRECISION):
+    num_longitude_bits = (precision * 5 + 1) // 2
+    num_latitude_bits = precision * 5 // 2
+    height = 180.0 / 2 ** num_latitude_bits
+    width = 360.0 / 2 ** num_longitude_bits
+    cells = set()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            neighbor_latitude = min(max(latitude + dy * height, -90.0), 90.0)
+            neighbor_longitude = (longitude + dx * width + 180.0) % 360.0 - 180.0
+            cells.add(encode_geohash(neighbor_latitude, neighbor_longitude, precision))
+    return cells
+
+def _has_coordinates(place):
+    return place.latitude is not None and place.longitude is not None and not math.isnan(place.latitude) and not math.isnan(place.longitude)
+
+def _get_geohash_blocks(places, precision):
+    blocks = {}
+    for i, p in enumerate(places):
+        if _has_coordinates(p):
+            blocks.setdefault(encode_geohash(p.latitude, p.longitude, precision), []).append(i)
+    return blocks
+
+def _get_address_blocks(normalized_addresses):
+    blocks = {}
+    for i, address in enumerate(normalized_addresses):
+        if address != '':
+            blocks.setdefault(address, []).append(i)
+    return blocks
+
+# returns the sorted pairs (i, j), i < j, of places in neighboring geohash
+# cells or with the same normalized address
+def _get_candidate_pairs(places, normalized_addresses, precision):
+    pairs = set()
+    geohash_blocks = _get_geohash_blocks(places, precision)
+    for cell, indexes in geohash_blocks.items():
+        p = places[indexes[0]]
+        neighbor_indexes = [j for c in get_geohash_neighborhood(p.latitude, p.longitude, precision) for j in geohash_blocks.get(c, [])]
+        pairs.update((i, j) for i in indexes for j in neighbor_indexes if i < j)
+    for indexes in _get_address_blocks(normalized_addresses).values():
+        pairs.update((i, j) for i in indexes for j in indexes if i < j)
+    return sorted(pairs)
+
+def _get_street_number(address):
+    first_word = address.split(' ', 1)[0]
+    return first_word if first_word.isdigit() else None
+
+# different street numbers are different places however similar the rest is
+def score_place_pair(name_a, address_a, name_b, address_b, threshold=0.0):
+    street_number_a = _get_street_number(address_a)
+    street_number_b = _get_street_number(address_b)
+    if street_number_a is not None and street_number_b is not None and street_number_a != street_number_b:
+        return 0.0
+    name_matcher = SequenceMatcher(None, name_a, name_b)
+    address_matcher = SequenceMatcher(None, address_a, address_b)
+    # the quick ratios are upper bounds of the ratios, so most pairs are
+    # rejected without the full comparison
+    if (name_matcher.real_quick_ratio() + address_matcher.real_quick_ratio()) / 2 < threshold:
+        return 0.0
+    if (name_matcher.quick_ratio() + address_matcher.quick_ratio()) / 2 < threshold:
+        return 0.0
+    return (name_matcher.ratio() + address_matcher.ratio()) / 2
+
+# returns the groups of likely duplicate places, each as (places, pairs) where
+# pairs are (place ID, place ID, score) for the scored pairs that joined it
+def find_duplicate_places(places, threshold=DEFAULT_THRESHOLD, precision=DEFAULT_GEOHASH_PRECISION):
+    normalized_names = [normalize_name(p.name) for p in places]
+    normalized_addresses = [normalize_address(p.address) for p in places]
+    parents = list(range(len(places)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    pairs = []
+    num_candidate_pairs = 0
+    for i, j in _get_candidate_pairs(places, normalized_addresses, precision):
+        num_candidate_pairs += 1
+        score = score_place_pair(normalized_names[i], normalized_addresses[i], normalized_names[j], normalized_addresses[j], threshold)
+        if score < threshold:
+            continue
+        pairs.append((i, j, score))
+        parents[find(i)] = find(j)
+    print(f'Scored {num_candidate_pairs} candidate pairs of {len(places)} places, {len(pairs)} above {threshold}')
+
+    roots_to_groups = {}
+    for i, j, score in pairs:
+        group = roots_to_groups.setdefault(find(i), ({}, []))
+        group[0][i] = places[i]
+        group[0][j] = places[j]
+        group[1].append((places[i].id, places[j].id, score))
+    return [(list(group_places.values()), group_pairs) for group_places, group_pairs in roots_to_groups.values()]
+
+# keeps the place with the most posts, breaking ties by ID so plans are stable
+def get_merge_target(places):
+    return min(places, key=lambda p: (-p.posts_count, p.id))
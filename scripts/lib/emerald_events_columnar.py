@@ -0,0 +1,216 @@
+import numpy as np
+from lib.timestamps import from_micros
+
+'''
+Columnar form of the post-driven generators in emerald/create_emerald_events.py
+(UserPostedTaste, UserTastedPlaceFirst, FriendTastedPlaceYouTasted and
+FriendLikedPlaceYouTasted). Posts become arrays of place, user, star rating
+and timestamp codes sorted by place and timestamp. Each user's first
+post at a place is a first occurrence in that order, and its position among
+the place's first posts is its rank. Queued posts are then joined against the
+friend lists: a queued post is a first taste if no friend has a lower rank at
+the place, and every friend with a lower rank among the posts rated at least
+3 stars gets a FriendTasted/Liked event. Events come out in the same order as
+the dict generators. Posts whose author has no users document (-1 in users)
+still get their UserPostedTaste event under the post's user ID, but are left
+out of the friend-based events, where the dict generators cannot look up the
+author either.
+'''
+
+MIN_FRIEND_STAR_RATING = 3
+LIKED_STAR_RATING = 5
+
+class PostArrays:
+    def __init__(self, ids, places, users, post_user_ids, star_ratings, timestamps, place_ids, user_ids, friend_indptr, friends):
+        self.ids = ids
+        self.places = places
+        self.users = users
+        self.post_user_ids = post_user_ids
+        self.star_ratings = star_ratings
+        self.timestamps = timestamps
+        self.place_ids = place_ids
+        self.user_ids = user_ids
+        self.friend_indptr = friend_indptr
+        self.friends = friends
+        # places sorted by code, then timestamp, then position among the posts
+        self.order = np.lexsort((np.arange(len(ids)), timestamps, places))
+
+# codes values by order of first appearance, which is the order the dict
+# generators visit places in
+def _encode_by_first_appearance(values):
+    unique_values, first_indexes, inverse = np.unique(np.array(values, dtype=object), return_index=True, return_inverse=True)
+    order = np.argsort(first_indexes, kind='stable')
+    codes = np.empty(len(order), dtype=np.int64)
+    codes[order] = np.arange(len(order))
+    return codes[inverse], list(unique_values[order])
+
+def build_post_arrays(snapshot):
+    print('Building post arrays...')
+    posts = snapshot.posts
+    users = snapshot.users
+    user_ids = list(users.ids)
+    user_indexes = {u: i for i, u in enumerate(user_ids)}
+
+    places, place_ids = _encode_by_first_appearance(posts['place'])
+    post_user_codes, post_user_ids = _encode_by_first_appearance(posts['user'])
+    post_user_indexes = np.array([user_indexes.get(u, -1) for u in post_user_ids], dtype=np.int64)
+
+    friend_counts = np.zeros(len(user_ids), dtype=np.int64)
+    friends = []
+    for i, user_friends in enumerate(users['friends']):
+        known_friends = [user_indexes[f] for f in user_friends if f in user_indexes]
+        friend_counts[i] = len(known_friends)
+        friends.extend(known_friends)
+    friend_indptr = np.concatenate([[0], np.cumsum(friend_counts)])
+
+    return PostArrays(
+        ids=list(posts.ids),
+        places=places,
+        users=post_user_indexes[post_user_codes],
+        post_user_ids=list(posts['user']),
+        star_ratings=np.frombuffer(posts['starRating'], dtype=np.float64),
+        timestamps=np.frombuffer(posts['timestamp'], dtype=np.int64),
+        place_ids=place_ids,
+        user_ids=user_ids,
+        friend_indptr=friend_indptr,
+        friends=np.array(friends, dtype=np.int64)
+    )
+
+class FirstPosts:
+    def __init__(self, posts, places, ranks, keys, key_order):
+        self.posts = posts
+        self.places = places
+        self.ranks = ranks
+        self.keys = keys
+        self.key_order = key_order
+
+def _place_user_keys(post_arrays, places, users):
+    return places * (len(post_arrays.user_ids) + 1) + users + 1
+
+# the first post of each user at each place among the posts in mask, with its
+# rank among the place's first posts
+def _get_first_posts(post_arrays, mask):
+    order = post_arrays.order[mask[post_arrays.order]]
+    keys = _place_user_keys(post_arrays, post_arrays.places[order], post_arrays.users[order])
+    _, first_indexes = np.unique(keys, return_index=True)
+    first_indexes.sort()
+    posts = order[first_indexes]
+    places = post_arrays.places[posts]
+    ranks = np.arange(len(posts)) - np.searchsorted(places, places, side='left')
+    keys = keys[first_indexes]
+    return FirstPosts(posts, places, ranks, keys, np.argsort(keys, kind='stable'))
+
+# returns the positions in first_posts of the given (place, user) pairs, or -1
+def _find_first_posts(post_arrays, first_posts, places, users):
+    keys = _place_user_keys(post_arrays, places, users)
+    if len(first_posts.keys) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    sorted_keys = first_posts.keys[first_posts.key_order]
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    found = sorted_keys[positions] == keys
+    return np.where(found, first_posts.key_order[positions], -1)
+
+# expands each user into its friends, returning (row, friend) arrays where row
+# indexes the given users
+def _expand_friends(post_arrays, users):
+    known_users = np.maximum(users, 0)
+    starts = post_arrays.friend_indptr[known_users]
+    counts = np.where(users >= 0, post_arrays.friend_indptr[known_users + 1] - starts, 0)
+    rows = np.repeat(np.arange(len(users)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, post_arrays.friends[np.repeat(starts, counts) + offsets]
+
+# returns the queued post indexes by known users that are their user's first
+# post at the place (within mask), with their queue positions and first post
+# positions
+def _get_queued_first_posts(post_arrays, first_posts, queue_posts):
+    positions = _find_first_posts(post_arrays, first_posts, post_arrays.places[queue_posts], post_arrays.users[queue_posts])
+    is_first = (positions >= 0) & (post_arrays.users[queue_posts] >= 0)
+    is_first[is_first] = first_posts.posts[positions[is_first]] == queue_posts[is_first]
+    queue_positions = np.flatnonzero(is_first)
+    return queue_posts[is_first], queue_positions, positions[is_first]
+
+def _to_event_timestamp(micros):
+    return from_micros(int(micros))
+
+def create_events_for_user_posted_taste_columnar(post_arrays, queue_posts, place_ids_to_data):
+    print('Creating events for users posting tastes...')
+    events = []
+    for p in queue_posts:
+        events.append({
+            'type': 'UserPostedTaste',
+            'user': post_arrays.post_user_ids[p],
+            'data': {
+                'post': post_arrays.ids[p],
+            },
+            'credsData': {
+                'placeName': place_ids_to_data[post_arrays.place_ids[post_arrays.places[p]]]['name']
+            },
+            'timestamp': _to_event_timestamp(post_arrays.timestamps[p])
+        })
+    return events
+
+def create_events_for_user_tasted_place_first_columnar(post_arrays, queue_posts, place_ids_to_data):
+    print('Creating events for users tasting place first...')
+    first_posts = _get_first_posts(post_arrays, np.ones(len(post_arrays.ids), dtype=bool))
+    posts, queue_positions, positions = _get_queued_first_posts(post_arrays, first_posts, queue_posts)
+
+    # a friend with an earlier first post at the place discovered it first
+    rows, friends = _expand_friends(post_arrays, post_arrays.users[posts])
+    friend_positions = _find_first_posts(post_arrays, first_posts, post_arrays.places[posts][rows], friends)
+    earlier = (friend_positions >= 0) & (first_posts.ranks[np.maximum(friend_positions, 0)] < first_posts.ranks[positions][rows])
+    beaten = np.bincount(rows[earlier], minlength=len(posts)) > 0
+
+    keep = np.flatnonzero(~beaten)
+    keep = keep[np.lexsort((queue_positions[keep], post_arrays.places[posts[keep]]))]
+    events = []
+    for p in posts[keep]:
+        events.append({
+            'type': 'UserTastedPlaceFirst',
+            'user': post_arrays.user_ids[post_arrays.users[p]],
+            'data': {
+                'post': post_arrays.ids[p]
+            },
+            'credsData': {
+                'placeName': place_ids_to_data[post_arrays.place_ids[post_arrays.places[p]]]['name'],
+            },
+            'timestamp': _to_event_timestamp(post_arrays.timestamps[p])
+        })
+    return events
+
+def create_events_for_friend_tasted_liked_place_you_tasted_columnar(post_arrays, queue_posts, place_ids_to_data, user_ids_to_data):
+    print('Creating events for friends tasting/liking places...')
+    first_posts = _get_first_posts(post_arrays, post_arrays.star_ratings >= MIN_FRIEND_STAR_RATING)
+    posts, queue_positions, positions = _get_queued_first_posts(post_arrays, first_posts, queue_posts)
+
+    # every friend whose first post rated at least 3 stars came earlier
+    rows, friends = _expand_friends(post_arrays, post_arrays.users[posts])
+    friend_positions = _find_first_posts(post_arrays, first_posts, post_arrays.places[posts][rows], friends)
+    friend_ranks = first_posts.ranks[np.maximum(friend_positions, 0)]
+    earlier = (friend_positions >= 0) & (friend_ranks < first_posts.ranks[positions][rows])
+    rows = rows[earlier]
+    friends = friends[earlier]
+    friend_ranks = friend_ranks[earlier]
+
+    order = np.lexsort((friend_ranks, queue_positions[rows], post_arrays.places[posts[rows]]))
+    events = []
+    for row, friend in zip(rows[order], friends[order]):
+        p = posts[row]
+        user_id = post_arrays.user_ids[post_arrays.users[p]]
+        payload = {
+            'user': post_arrays.user_ids[friend],
+            'data': {
+                'user': user_id,
+                'post': post_arrays.ids[p]
+            },
+            'credsData': {
+                'friendFirstName': user_ids_to_data[user_id]['firstName'],
+                'placeName': place_ids_to_data[post_arrays.place_ids[post_arrays.places[p]]]['name']
+            },
+            'timestamp': _to_event_timestamp(post_arrays.timestamps[p])
+        }
+        if post_arrays.star_ratings[p] == LIKED_STAR_RATING:
+            events.append({**{'type': 'FriendLikedPlaceYouTasted'}, **payload})
+        else:
+            events.append({**{'type': 'FriendTastedPlaceYouTasted'}, **payload})
+    return events
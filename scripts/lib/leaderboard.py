@@ -0,0 +1,75 @@
+import heapq
+from lib.state import load_state, save_state
+
+'''
+The Emerald leaderboard is the top 20 users by creds, extended with everyone
+tied with the 20th. It is picked with a heap instead of sorting every user,
+and when creds only went up since the last ranking it is updated from the
+previous top users and the users whose creds changed: a user outside the
+previous top who gained nothing cannot have overtaken anyone in it.
+
+Each run records a rank snapshot, the ranked top users for the day, so the
+current leaderboard and how it moved can be read back without recomputing
+creds from events.
+
+Rank history
+
+snapshots       date (YYYY-MM-DD) -> [[user ID, creds], ...] in rank order
+'''
+
+NUM_EMERALD_RANKS = 20
+
+def _sort_by_creds(user_ids, user_ids_to_creds):
+    return sorted(user_ids, key=lambda u: user_ids_to_creds[u], reverse=True)
+
+def get_top_user_ids(user_ids_to_creds, k=NUM_EMERALD_RANKS, user_ids=None):
+    user_ids = user_ids_to_creds.keys() if user_ids is None else user_ids
+    top_user_ids = heapq.nlargest(k, user_ids, key=lambda u: user_ids_to_creds[u])
+    if len(top_user_ids) < k:
+        return _sort_by_creds(top_user_ids, user_ids_to_creds)
+    threshold = user_ids_to_creds[top_user_ids[-1]]
+    return _sort_by_creds([u for u in user_ids if user_ids_to_creds[u] >= threshold], user_ids_to_creds)
+
+# recomputes the top users from the previous top users and the users whose
+# creds changed, falling back to all users if anyone's creds went down
+def update_top_user_ids(previous_top_user_ids, user_ids_to_creds, user_ids_to_previous_creds, k=NUM_EMERALD_RANKS):
+    changed_user_ids = [u for u, c in user_ids_to_creds.items() if c != user_ids_to_previous_creds.get(u, 0)]
+    if previous_top_user_ids is None or any(user_ids_to_creds[u] < user_ids_to_previous_creds.get(u, 0) for u in changed_user_ids):
+        return get_top_user_ids(user_ids_to_creds, k)
+    candidate_user_ids = {u for u in previous_top_user_ids if u in user_ids_to_creds} | set(changed_user_ids)
+    if len(candidate_user_ids) < k:
+        return get_top_user_ids(user_ids_to_creds, k)
+    return get_top_user_ids(user_ids_to_creds, k, candidate_user_ids)
+
+# returns [(rank, user ID, creds), ...] with tied users sharing a rank
+def rank_user_ids(user_ids, user_ids_to_creds):
+    ranking = []
+    for i, u in enumerate(user_ids):
+        creds = user_ids_to_creds[u]
+        rank = ranking[-1][0] if i > 0 and ranking[-1][2] == creds else i + 1
+        ranking.append((rank, u, creds))
+    return ranking
+
+def load_rank_history(path):
+    return load_state(path, {'snapshots': {}})
+
+def save_rank_snapshot(path, rank_history, date, top_user_ids, user_ids_to_creds):
+    rank_history['snapshots'][date.isoformat()] = [[u, user_ids_to_creds[u]] for u in top_user_ids]
+    save_state(path, rank_history)
+
+# returns (date, user ID -> creds) of the latest snapshot taken before the
+# given date, or of the latest snapshot when date is None
+def get_latest_rank_snapshot(rank_history, before=None):
+    dates = sorted(d for d in rank_history['snapshots'] if before is None or d < before.isoformat())
+    if len(dates) == 0:
+        return None, None
+    return dates[-1], dict(rank_history['snapshots'][dates[-1]])
+
+# returns the users that entered the top, left it and changed rank within it
+def get_rank_changes(previous_top_user_ids, previous_user_ids_to_creds, top_user_ids, user_ids_to_creds):
+    previous_ranks = {u: r for r, u, _ in rank_user_ids(previous_top_user_ids, previous_user_ids_to_creds)}
+    ranks = {u: r for r, u, _ in rank_user_ids(top_user_ids, user_ids_to_creds)}
+    entered = [u for u in top_user_ids if u not in previous_ranks]
+    left = [u for u in previous_top_user_ids if u not in ranks]
+    moved = [(u, previous_ranks[u], ranks[u]) for u in top_user_ids if u in previous_ranks and previous_ranks[u] != ranks[u]]
+    return entered, left, moved
@@ -0,0 +1,45 @@
+import time
+from collections import Counter
+from lib.batch_writer import BatchWriter
+
+'''
+Creates notification documents through a BatchWriter, so fanning a
+notification out to many owners (e.g. every friend of a user) is a handful of
+concurrent batched commits rather than one request per notification. Queuing
+blocks once too many batches are waiting to commit.
+'''
+
+class NotificationWriter:
+    def __init__(self, db, max_workers=8, max_in_flight=16):
+        self.db = db
+        self.writer = BatchWriter(db, 'notifications', max_workers=max_workers, max_in_flight=max_in_flight)
+        self.types_to_counts = Counter()
+        self.start_time = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, payload):
+        self.types_to_counts[payload['type']] += 1
+        self.writer.create(self.db.collection('notifications').document(), payload)
+
+    # creates a copy of the payload for each owner
+    def fan_out(self, owner_ids, payload):
+        for o in owner_ids:
+            self.add({**payload, 'ownerId': o})
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.start_time
+        num_notifications = sum(self.types_to_counts.values())
+        rate = num_notifications / elapsed if elapsed > 0 else 0
+        types = ', '.join(f'{t}: {c}' for t, c in sorted(self.types_to_counts.items()))
+        print(f'Created {num_notifications} notifications in {elapsed:.2f}s ({rate:.1f}/s){f" - {types}" if types else ""}')
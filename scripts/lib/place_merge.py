@@ -0,0 +1,146 @@
+from lib.batch_writer import BatchWriter
+
+'''
+Merges duplicate places into the place kept for them. Every document that
+references a removed place is read first and its rewrite collected so each
+document is written once:
+
+queuewanttotastes   place (reference)
+users               tasted, wantToTaste (references)
+notifications       notificationLink (place ID)
+posts               place (reference)
+events              data.place (place ID, FriendWantsToTastePlaceYouTasted)
+
+The documents are looked up in the place reference index (lib/place_refs.py)
+when one is given and read with get_all, and are otherwise found with `in` /
+`array_contains_any` queries over up to 30 places at a time. The index is
+trusted as is, so it must be refreshed from a freshly synced cache right
+before the merge. Either way a document is only rewritten if it still
+references a removed place when read.
+
+A user's tasted and wantToTaste arrays are replaced whole in a single update,
+so no user is ever seen with the place missing from one of them, and the
+update only applies if the user was not written since it was read. Similarity
+documents only reference users, so they need no rewrite. The removed places
+are deleted once every rewrite has committed; if any fail nothing is deleted
+and the plan can be applied again.
+'''
+
+_QUERY_CHUNK_SIZE = 30
+_GET_ALL_CHUNK_SIZE = 300
+
+# collection -> [(field, whether it holds references, query operator)]
+_PLACE_REF_FIELDS = {
+    'queuewanttotastes': [('place', True, 'in')],
+    'users': [('tasted', True, 'array_contains_any'), ('wantToTaste', True, 'array_contains_any')],
+    'notifications': [('notificationLink', False, 'in')],
+    'posts': [('place', True, 'in')],
+    'events': [('data.place', False, 'in')],
+}
+
+# returns removed place ID -> kept place ID for the merges of a plan
+def get_place_ids_to_targets(merge_plan):
+    place_ids_to_targets = {}
+    target_ids = set()
+    for merge in merge_plan['merges']:
+        target_ids.add(merge['target'])
+        for p in merge['remove']:
+            if p == merge['target']:
+                raise ValueError(f'place {p} is both kept and removed')
+            if p in place_ids_to_targets:
+                raise ValueError(f'place {p} is removed by more than one merge')
+            place_ids_to_targets[p] = merge['target']
+    merged_targets = target_ids & place_ids_to_targets.keys()
+    if len(merged_targets) > 0:
+        raise ValueError(f'places {", ".join(sorted(merged_targets))} are both kept and removed')
+    return place_ids_to_targets
+
+def _chunks(values, chunk_size):
+    return [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+def _query_referencing_docs(db, collection, place_ids_to_targets):
+    fields = _PLACE_REF_FIELDS[collection]
+    place_ids = sorted(place_ids_to_targets)
+    for field, is_ref, op in fields:
+        values = [db.collection('places').document(p) for p in place_ids] if is_ref else place_ids
+        for chunk in _chunks(values, _QUERY_CHUNK_SIZE):
+            yield from db.collection(collection).where(field, op, chunk).select([f for f, _, _ in fields]).stream()
+
+def _get_indexed_referencing_docs(db, collection, place_ids_to_targets, place_ids_to_refs):
+    fields = _PLACE_REF_FIELDS[collection]
+    doc_ids = set()
+    for p in place_ids_to_targets:
+        for field, _, _ in fields:
+            doc_ids.update(place_ids_to_refs.get(p, {}).get(f'{collection}.{field}', []))
+    refs = [db.collection(collection).document(d) for d in sorted(doc_ids)]
+    for chunk in _chunks(refs, _GET_ALL_CHUNK_SIZE):
+        for d in db.get_all(chunk, field_paths=[f for f, _, _ in fields]):
+            if d.exists:
+                yield d
+
+def _replace_refs(refs, place_ids_to_targets, db):
+    replaced = []
+    replaced_ids = set()
+    for r in refs:
+        place_id = place_ids_to_targets.get(r.id, r.id)
+        if place_id in replaced_ids:
+            continue
+        replaced_ids.add(place_id)
+        replaced.append(r if place_id == r.id else db.collection('places').document(place_id))
+    return replaced
+
+def _get_rewrite(db, d, fields, place_ids_to_targets):
+    patch = {}
+    option = None
+    for field, is_ref, _ in fields:
+        value = d.get(field)
+        if isinstance(value, list):
+            if any(r.id in place_ids_to_targets for r in value):
+                patch[field] = _replace_refs(value, place_ids_to_targets, db)
+                option = db.write_option(last_update_time=d.update_time)
+        elif is_ref and value is not None and value.id in place_ids_to_targets:
+            patch[field] = db.collection('places').document(place_ids_to_targets[value.id])
+        elif not is_ref and value in place_ids_to_targets:
+            patch[field] = place_ids_to_targets[value]
+    return patch, option
+
+# returns collection -> document ID -> (reference, patch, write option)
+def collect_place_rewrites(db, place_ids_to_targets, place_ids_to_refs=None):
+    print(f'Collecting rewrites for {len(place_ids_to_targets)} removed places...')
+    rewrites = {}
+    for collection, fields in _PLACE_REF_FIELDS.items():
+        if place_ids_to_refs is None:
+            docs = _query_referencing_docs(db, collection, place_ids_to_targets)
+        else:
+            docs = _get_indexed_referencing_docs(db, collection, place_ids_to_targets, place_ids_to_refs)
+        # keep the latest read of documents matched by more than one query
+        doc_ids_to_docs = {}
+        for d in docs:
+            if d.id not in doc_ids_to_docs or d.update_time > doc_ids_to_docs[d.id].update_time:
+                doc_ids_to_docs[d.id] = d
+        collection_rewrites = rewrites.setdefault(collection, {})
+        for doc_id, d in doc_ids_to_docs.items():
+            patch, option = _get_rewrite(db, d, fields, place_ids_to_targets)
+            if len(patch) > 0:
+                collection_rewrites[doc_id] = (d.reference, patch, option)
+        print(f'Found {len(collection_rewrites)} {collection} to rewrite...')
+    return rewrites
+
+def apply_place_rewrites(db, rewrites, max_workers=8):
+    for collection, collection_rewrites in rewrites.items():
+        with BatchWriter(db, collection, max_workers=max_workers) as writer:
+            for ref, patch, option in collection_rewrites.values():
+                writer.update(ref, patch, option)
+
+def delete_places(db, place_ids, max_workers=8):
+    print(f'Deleting {len(place_ids)} places...')
+    with BatchWriter(db, 'places', max_workers=max_workers) as writer:
+        for p in sorted(place_ids):
+            writer.delete(db.collection('places').document(p))
+
+def merge_places(db, merge_plan, max_workers=8, place_ids_to_refs=None):
+    place_ids_to_targets = get_place_ids_to_targets(merge_plan)
+    print(f'Merging {len(place_ids_to_targets)} places into {len(set(place_ids_to_targets.values()))} places...')
+    rewrites = collect_place_rewrites(db, place_ids_to_targets, place_ids_to_refs)
+    apply_place_rewrites(db, rewrites, max_workers)
+    delete_places(db, place_ids_to_targets, max_workers)
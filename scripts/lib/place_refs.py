@@ -0,0 +1,112 @@
+from lib.snapshot import to_row
+from lib.state import load_state, save_state
+
+'''
+A reverse-reference index from place IDs to the documents that reference
+them, built from a snapshot so finding what a place merge or deletion touches
+is a lookup instead of a query per place and collection:
+
+posts.place                         post IDs
+users.tasted                        user IDs
+users.wantToTaste                   user IDs
+queuewanttotastes.place             queue item IDs
+notifications.notificationLink      notification IDs
+events.data.place                   event IDs
+
+The index is stored as the place references of each document, with the
+document's update time when the snapshot is backed by a cache. A refresh then
+fully syncs the cache (a cursor sync would miss edits) and reads everything
+from it, the update times, the rows of documents whose update time changed
+and the documents that were deleted, so the index is as current as the sync
+and never mixes in rows of an older snapshot file. Without a cache every row
+of the snapshot is compared.
+
+State
+
+collections     collection -> document ID -> [update time, [[field, place ID], ...]]
+'''
+
+def _get_post_place_refs(row, place_ids):
+    return [['place', row['place']]] if row['place'] is not None else []
+
+def _get_user_place_refs(row, place_ids):
+    return [['tasted', p] for p in row['tasted']] + [['wantToTaste', p] for p in row['wantToTaste']]
+
+def _get_queue_want_to_taste_place_refs(row, place_ids):
+    return [['place', row['place']]] if row['place'] is not None else []
+
+# notification links are user IDs for most notification types
+def _get_notification_place_refs(row, place_ids):
+    return [['notificationLink', row['notificationLink']]] if row['notificationLink'] in place_ids else []
+
+def _get_event_place_refs(row, place_ids):
+    place_id = (row['data'] or {}).get('place')
+    return [['data.place', place_id]] if place_id is not None else []
+
+COLLECTIONS_TO_GET_PLACE_REFS = {
+    'posts': _get_post_place_refs,
+    'users': _get_user_place_refs,
+    'queuewanttotastes': _get_queue_want_to_taste_place_refs,
+    'notifications': _get_notification_place_refs,
+    'events': _get_event_place_refs,
+}
+
+def load_place_refs(path):
+    return load_state(path, {'collections': {}})
+
+def save_place_refs(path, place_refs):
+    save_state(path, place_refs)
+
+def _refresh_collection_from_cache(doc_ids_to_refs, cache, collection, get_place_refs, place_ids):
+    update_times = cache.update_times(collection)
+    num_changed = 0
+    for doc_id in doc_ids_to_refs.keys() - update_times.keys():
+        del doc_ids_to_refs[doc_id]
+        num_changed += 1
+    for doc_id, update_time in update_times.items():
+        previous = doc_ids_to_refs.get(doc_id)
+        if previous is not None and previous[0] == update_time:
+            continue
+        refs = get_place_refs(to_row(collection, cache.document(collection, doc_id)), place_ids)
+        if previous is None or previous[1] != refs:
+            num_changed += 1
+        doc_ids_to_refs[doc_id] = [update_time, refs]
+    return num_changed, len(update_times)
+
+def _refresh_collection_from_table(doc_ids_to_refs, table, get_place_refs, place_ids):
+    num_changed = 0
+    for doc_id in doc_ids_to_refs.keys() - table.indexes.keys():
+        del doc_ids_to_refs[doc_id]
+        num_changed += 1
+    for doc_id, row in table.rows():
+        refs = get_place_refs(row, place_ids)
+        previous = doc_ids_to_refs.get(doc_id)
+        if previous is None or previous[1] != refs:
+            num_changed += 1
+        doc_ids_to_refs[doc_id] = [None, refs]
+    return num_changed, len(table)
+
+def refresh_place_refs(place_refs, snapshot):
+    cache = snapshot.cache
+    if cache is not None:
+        for collection in ['places', *COLLECTIONS_TO_GET_PLACE_REFS]:
+            cache.sync(snapshot.db, collection, full=True)
+        place_ids = cache.update_times('places')
+    else:
+        place_ids = snapshot.places.indexes
+    for collection, get_place_refs in COLLECTIONS_TO_GET_PLACE_REFS.items():
+        doc_ids_to_refs = place_refs['collections'].setdefault(collection, {})
+        if cache is not None:
+            num_changed, num_docs = _refresh_collection_from_cache(doc_ids_to_refs, cache, collection, get_place_refs, place_ids)
+        else:
+            num_changed, num_docs = _refresh_collection_from_table(doc_ids_to_refs, snapshot.table(collection), get_place_refs, place_ids)
+        print(f'Refreshed place references of {num_changed} {collection} out of {num_docs}...')
+
+# returns place ID -> '<collection>.<field>' -> [document ID, ...]
+def get_place_ids_to_refs(place_refs):
+    place_ids_to_refs = {}
+    for collection, doc_ids_to_refs in place_refs['collections'].items():
+        for doc_id, (_, refs) in doc_ids_to_refs.items():
+            for field, place_id in refs:
+                place_ids_to_refs.setdefault(place_id, {}).setdefault(f'{collection}.{field}', []).append(doc_id)
+    return place_ids_to_refs
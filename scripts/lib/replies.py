@@ -0,0 +1,32 @@
+from firebase_admin import firestore
+
+'''
+Replies live in a `replies` subcollection under each post. Instead of one
+request per post, they are streamed with a single collection group query,
+paginated on the document path or, when only replies newer than a cursor are
+needed, on the reply timestamp (which requires the collection group index on
+replies.timestamp).
+'''
+
+_PAGE_SIZE = 1000
+
+def stream_replies(db, since=None, page_size=_PAGE_SIZE):
+    query = db.collection_group('replies')
+    if since is None:
+        query = query.order_by(firestore.FieldPath.document_id())
+    else:
+        query = query.where('timestamp', '>', since).order_by('timestamp')
+    query = query.limit(page_size)
+
+    last_reply = None
+    while True:
+        page_query = query if last_reply is None else query.start_after(last_reply)
+        page = list(page_query.stream())
+        for r in page:
+            yield r
+        if len(page) < page_size:
+            return
+        last_reply = page[-1]
+
+def get_reply_post_id(reply):
+    return reply.reference.parent.parent.id
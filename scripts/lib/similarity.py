@@ -0,0 +1,61 @@
+'''
+Similarity between two users is based on the places both of them tasted: with
+n common places and r_u, r_f the average star rating (across retastes) each
+user gave a place, score = (4 * n - sum(|r_u - r_f|)) / (4 * n). Pairs with
+fewer than 5 common places have no similarity.
+'''
+
+MIN_COMMON_PLACES = 5
+MAX_STAR_RATING_DIFF = 4
+
+# maps (user ID, place ID) to the user's average star rating for the place in a
+# single pass over the posts table
+def get_user_place_ratings(posts):
+    users = posts['user']
+    places = posts['place']
+    star_ratings = posts['starRating']
+    sums = {}
+    counts = {}
+    for i in range(len(posts)):
+        key = (users[i], places[i])
+        sums[key] = sums.get(key, 0) + star_ratings[i]
+        counts[key] = counts.get(key, 0) + 1
+    return {k: sums[k] / counts[k] for k in sums}
+
+# maps user IDs to the set of places they tasted and rated
+def get_user_ids_to_rated_place_ids(user_ids_to_tasted, user_place_ratings):
+    user_ids_to_rated_place_ids = {}
+    for u, tasted in user_ids_to_tasted.items():
+        user_ids_to_rated_place_ids[u] = {p for p in tasted if (u, p) in user_place_ratings}
+    return user_ids_to_rated_place_ids
+
+# maps frozenset({user ID, user ID}) to the IDs of the similarity documents
+# for that pair
+def get_pair_ids_to_similarity_ids(similarity_ids_to_data):
+    pair_ids_to_similarity_ids = {}
+    for s, d in similarity_ids_to_data.items():
+        pair = frozenset((d['users'] or {}).keys())
+        pair_ids_to_similarity_ids.setdefault(pair, []).append(s)
+    return pair_ids_to_similarity_ids
+
+# returns the sufficient statistics of a pair: the number of common places and
+# the sum of absolute differences of the average star ratings
+def calculate_pair_stats(u1, u2, user_ids_to_rated_place_ids, user_place_ratings):
+    u1_place_ids = user_ids_to_rated_place_ids.get(u1, set())
+    u2_place_ids = user_ids_to_rated_place_ids.get(u2, set())
+    if len(u2_place_ids) < len(u1_place_ids):
+        u1_place_ids, u2_place_ids = u2_place_ids, u1_place_ids
+    count = 0
+    diff = 0
+    for p in u1_place_ids:
+        if p not in u2_place_ids:
+            continue
+        count += 1
+        diff += abs(user_place_ratings[(u1, p)] - user_place_ratings[(u2, p)])
+    return count, diff
+
+def calculate_score(count, diff):
+    if count < MIN_COMMON_PLACES:
+        return None
+    max_diff = MAX_STAR_RATING_DIFF * count
+    return (max_diff - diff) / max_diff
@@ -0,0 +1,129 @@
+import numpy as np
+from lib.similarity import MAX_STAR_RATING_DIFF, MIN_COMMON_PLACES
+from scipy import sparse
+
+'''
+Vectorized form of lib/similarity.py. Ratings live in a sparse user x place
+matrix R (averaged across retastes) with mask M. For two users the number of
+common places is (M M^T)[u, f] and, writing |a - b| = a + b - 2 * min(a, b)
+and expanding min over the distinct rating levels v_0 < v_1 < ... as
+min(a, b) = v_0 + sum_k (v_k - v_(k-1)) * [a >= v_k] * [b >= v_k], the sum of
+absolute differences is
+
+    (S M^T + M S^T - 2 * sum_k (v_k - v_(k-1)) * A_k A_k^T)[u, f]
+
+with S = R - v_0 on the mask and A_k = [R >= v_k]. Every term is a sparse
+matrix product, computed a block of users at a time.
+'''
+
+class RatingMatrix:
+    def __init__(self, user_ids, place_ids, ratings):
+        self.user_ids = user_ids
+        self.place_ids = place_ids
+        self.user_indexes = {u: i for i, u in enumerate(user_ids)}
+        self.ratings = ratings
+
+# builds the user x place matrix of average star ratings, keeping only the
+# places each user tasted
+def build_rating_matrix(posts, user_ids_to_tasted):
+    print('Building rating matrix...')
+    user_ids = sorted(user_ids_to_tasted.keys())
+    user_indexes = {u: i for i, u in enumerate(user_ids)}
+    place_indexes = {}
+    user_ids_to_tasted_sets = {u: set(t) for u, t in user_ids_to_tasted.items()}
+
+    rows = []
+    cols = []
+    star_ratings = []
+    users = posts['user']
+    places = posts['place']
+    post_star_ratings = posts['starRating']
+    for i in range(len(posts)):
+        u = users[i]
+        p = places[i]
+        if u not in user_indexes or p not in user_ids_to_tasted_sets[u] or np.isnan(post_star_ratings[i]):
+            continue
+        rows.append(user_indexes[u])
+        cols.append(place_indexes.setdefault(p, len(place_indexes)))
+        star_ratings.append(post_star_ratings[i])
+
+    shape = (len(user_ids), len(place_indexes))
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    # duplicate (user, place) entries are summed when converting to CSR
+    sums = sparse.coo_matrix((np.array(star_ratings, dtype=np.float64), (rows, cols)), shape=shape).tocsr()
+    counts = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=shape).tocsr()
+    ratings = sums.copy()
+    ratings.data = sums.data / counts.data
+
+    place_ids = [None] * len(place_indexes)
+    for p, i in place_indexes.items():
+        place_ids[i] = p
+    return RatingMatrix(user_ids, place_ids, ratings)
+
+def _threshold(ratings, level):
+    matrix = ratings.copy()
+    matrix.data = (matrix.data >= level).astype(np.float64)
+    matrix.eliminate_zeros()
+    return matrix
+
+# returns (user index, user index, common place count, sum of differences)
+# arrays for the requested pairs of user indexes or, when pairs is None, for
+# every pair of users with at least MIN_COMMON_PLACES common places
+def calculate_pair_stats_matrix(rating_matrix, pairs=None, batch_size=1024):
+    ratings = rating_matrix.ratings
+    levels = np.unique(ratings.data)
+    mask = ratings.copy()
+    mask.data = np.ones_like(mask.data)
+    shifted = ratings.copy()
+    shifted.data = shifted.data - (levels[0] if len(levels) else 0)
+    thresholds = [(levels[k] - levels[k - 1], _threshold(ratings, levels[k])) for k in range(1, len(levels))]
+
+    mask_t = mask.T.tocsr()
+    shifted_t = shifted.T.tocsr()
+    thresholds = [(w, a, a.T.tocsr()) for w, a in thresholds]
+
+    if pairs is not None:
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        pairs = np.sort(pairs, axis=1)
+        pairs = pairs[np.argsort(pairs[:, 0], kind='stable')]
+
+    results = ([], [], [], [])
+    num_users = ratings.shape[0]
+    for start in range(0, num_users, batch_size):
+        end = min(start + batch_size, num_users)
+        if pairs is not None:
+            lo, hi = np.searchsorted(pairs[:, 0], [start, end])
+            if lo == hi:
+                continue
+        block_counts = mask[start:end] @ mask_t
+        block_diffs = shifted[start:end] @ mask_t + mask[start:end] @ shifted_t
+        for w, a, a_t in thresholds:
+            block_diffs = block_diffs - 2 * w * (a[start:end] @ a_t)
+
+        if pairs is None:
+            block_counts = sparse.triu(block_counts, k=start + 1, format='coo')
+            keep = block_counts.data >= MIN_COMMON_PLACES
+            rows = block_counts.row[keep]
+            cols = block_counts.col[keep]
+            counts = block_counts.data[keep]
+        else:
+            rows = pairs[lo:hi, 0] - start
+            cols = pairs[lo:hi, 1]
+            counts = np.asarray(block_counts[rows, cols]).ravel()
+        diffs = np.asarray(block_diffs.tocsr()[rows, cols]).ravel()
+
+        results[0].append(rows + start)
+        results[1].append(cols)
+        results[2].append(counts.astype(np.int64))
+        results[3].append(diffs)
+
+    if len(results[0]) == 0:
+        return tuple(np.array([], dtype=t) for t in (np.int64, np.int64, np.int64, np.float64))
+    return tuple(np.concatenate(r) for r in results)
+
+def calculate_scores_matrix(counts, diffs):
+    max_diffs = MAX_STAR_RATING_DIFF * counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (max_diffs - diffs) / max_diffs
+    return np.where(counts >= MIN_COMMON_PLACES, scores, np.nan)
@@ -0,0 +1,258 @@
+import math
+import os
+import pickle
+import sys
+from array import array
+from collections import namedtuple
+from lib.auth_users import stream_auth_users
+from lib.replies import get_reply_post_id, stream_replies
+from lib.snapshot_cache import SnapshotCache
+from lib.timestamps import from_micros, to_micros
+
+'''
+A snapshot loads each Firestore collection at most once and stores it as a
+column-oriented table instead of a dict of dicts. Document IDs (including IDs
+of referenced documents) are interned so repeated references share a single
+string, and numeric fields are kept in typed arrays.
+
+Kind        Storage                 Missing value
+
+str         list of str             default
+ref         list of interned IDs    None
+refs        list of tuples of IDs   ()
+int         array('q')              default
+float       array('d')              NaN
+bool        array('b')              default
+timestamp   array('q') (epoch us)   MISSING (lib/timestamps.py)
+object      list                    default
+'''
+
+Column = namedtuple('Column', ['name', 'kind', 'default'], defaults=[None])
+
+SCHEMAS = {
+    'users': [
+        Column('handle', 'str'),
+        Column('firstName', 'str'),
+        Column('lastName', 'str'),
+        Column('email', 'str'),
+        Column('phoneNumber', 'str'),
+        Column('hasSignedIn', 'bool', True),
+        Column('emerald', 'bool', False),
+        Column('emeraldCreds', 'int', 0),
+        Column('friends', 'refs'),
+        Column('tasted', 'refs'),
+        Column('wantToTaste', 'refs'),
+    ],
+    'posts': [
+        Column('user', 'ref'),
+        Column('place', 'ref'),
+        Column('starRating', 'float'),
+        Column('review', 'str'),
+        Column('retaste', 'bool', False),
+        Column('cuisines', 'object'),
+        Column('timestamp', 'timestamp'),
+        Column('replyOwnerRefs', 'refs'),
+    ],
+    'places': [
+        Column('name', 'str'),
+        Column('address', 'str'),
+        Column('cuisines', 'object'),
+        Column('postsCount', 'int', 0),
+        Column('latitude', 'float'),
+        Column('longitude', 'float'),
+    ],
+    'events': [
+        Column('user', 'str'),
+        Column('type', 'str'),
+        Column('data', 'object'),
+        Column('credsData', 'object'),
+        Column('timestamp', 'timestamp'),
+        Column('createdAt', 'timestamp'),
+    ],
+    'notifications': [
+        Column('ownerId', 'str'),
+        Column('type', 'str'),
+        Column('notificationLink', 'str'),
+        Column('timestamp', 'timestamp'),
+    ],
+    'sessions': [
+        Column('userPhoneNumber', 'str'),
+        Column('timestamp', 'timestamp'),
+    ],
+    'similarities': [
+        Column('users', 'object'),
+        Column('score', 'float'),
+    ],
+    'queueposts': [
+        Column('postId', 'str'),
+    ],
+    'queuewanttotastes': [
+        Column('user', 'ref'),
+        Column('place', 'ref'),
+        Column('timestamp', 'timestamp'),
+    ],
+    # replies of every post, loaded with a collection group query
+    'replies': [
+        Column('post', 'str'),
+        Column('owner', 'ref'),
+        Column('timestamp', 'timestamp'),
+    ],
+    # Firebase Auth users keyed by UID rather than a Firestore collection
+    'auth': [
+        Column('phoneNumber', 'str'),
+        Column('creationTimestamp', 'timestamp'),
+    ],
+}
+
+_ARRAY_TYPECODES = {
+    'int': 'q',
+    'float': 'd',
+    'bool': 'b',
+    'timestamp': 'q',
+}
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+def _encode(column, value):
+    kind = column.kind
+    if kind == 'ref':
+        return None if value is None else sys.intern(value.id)
+    if kind == 'refs':
+        return tuple(sys.intern(r.id) for r in value or [])
+    if kind == 'timestamp':
+        return to_micros(value)
+    if value is None:
+        return math.nan if kind == 'float' else column.default
+    if kind == 'str':
+        return _intern(value)
+    return value
+
+def _decode(column, value):
+    if column.kind == 'timestamp':
+        return from_micros(value)
+    if column.kind == 'bool':
+        return bool(value)
+    return value
+
+# returns a document as the row its table would hold, e.g. for documents read
+# from the cache without loading their whole table
+def to_row(collection, doc_dict):
+    return {c.name: _decode(c, _encode(c, doc_dict.get(c.name))) for c in SCHEMAS[collection]}
+
+class Table:
+    def __init__(self, collection, columns):
+        self.collection = collection
+        self.columns = columns
+        self.ids = []
+        self.indexes = {}
+        self.data = {}
+        for c in columns:
+            typecode = _ARRAY_TYPECODES.get(c.kind)
+            self.data[c.name] = array(typecode) if typecode else []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.indexes
+
+    def __getitem__(self, column_name):
+        return self.data[column_name]
+
+    def append(self, doc_id, doc_dict):
+        self.indexes[doc_id] = len(self.ids)
+        self.ids.append(sys.intern(doc_id))
+        for c in self.columns:
+            self.data[c.name].append(_encode(c, doc_dict.get(c.name)))
+
+    def index(self, doc_id):
+        return self.indexes[doc_id]
+
+    def row(self, i):
+        return {c.name: _decode(c, self.data[c.name][i]) for c in self.columns}
+
+    def get(self, doc_id):
+        i = self.indexes.get(doc_id)
+        return None if i is None else self.row(i)
+
+    def rows(self):
+        for i, doc_id in enumerate(self.ids):
+            yield doc_id, self.row(i)
+
+    # maps each value of a ref or str column to the IDs of the documents with
+    # that value, in a single pass
+    def group_by(self, column_name):
+        values_to_ids = {}
+        for doc_id, value in zip(self.ids, self.data[column_name]):
+            values_to_ids.setdefault(value, []).append(doc_id)
+        return values_to_ids
+
+def _load_table(db, collection, cache=None):
+    table = Table(collection, SCHEMAS[collection])
+    if collection == 'auth':
+        print('Getting authenticated users...')
+        for uid, auth_dict in stream_auth_users():
+            table.append(uid, auth_dict)
+        return table
+    if collection == 'replies':
+        print('Getting replies...')
+        for r in stream_replies(db):
+            table.append(r.id, {**r.to_dict(), 'post': get_reply_post_id(r)})
+        return table
+    if cache is not None:
+        cache.sync(db, collection)
+        print(f'Getting {collection} from {cache.path}...')
+        for doc_id, doc_dict in cache.documents(collection):
+            table.append(doc_id, doc_dict)
+        return table
+    print(f'Getting {collection}...')
+    for d in db.collection(collection).stream():
+        table.append(d.id, d.to_dict())
+    return table
+
+class Snapshot:
+    def __init__(self, db, tables=None, cache=None):
+        self.db = db
+        self.tables = tables or {}
+        self.cache = cache
+
+    def table(self, collection):
+        if collection not in self.tables:
+            self.tables[collection] = _load_table(self.db, collection, self.cache)
+        return self.tables[collection]
+
+    @property
+    def users(self):
+        return self.table('users')
+
+    @property
+    def posts(self):
+        return self.table('posts')
+
+    @property
+    def places(self):
+        return self.table('places')
+
+    def save(self, path):
+        print(f'Saving snapshot of {", ".join(sorted(self.tables))} to {path}...')
+        with open(path, 'wb') as f:
+            pickle.dump(self.tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def add_snapshot_arguments(parser):
+    parser.add_argument('--snapshot-path', type=str, required=False)
+    parser.add_argument('--snapshot-cache-path', type=str, required=False)
+
+# returns a snapshot backed by the file written by create_snapshot.py when one
+# exists so every script in a pipeline run shares the same reads; collections
+# missing from the file are loaded on first use, from the on-disk cache after
+# fetching only the documents that changed since its last sync when a cache
+# path is given and from a full Firestore stream otherwise
+def load_snapshot(db, snapshot_path=None, snapshot_cache_path=None):
+    cache = SnapshotCache(snapshot_cache_path) if snapshot_cache_path else None
+    if snapshot_path is None or not os.path.exists(snapshot_path):
+        return Snapshot(db, cache=cache)
+    print(f'Loading snapshot from {snapshot_path}...')
+    with open(snapshot_path, 'rb') as f:
+        tables = pickle.load(f)
+    return Snapshot(db, tables, cache)
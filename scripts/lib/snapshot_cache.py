@@ -0,0 +1,223 @@
+import datetime
+import json
+import sqlite3
+from firebase_admin import firestore
+from lib.timestamps import MISSING, MICROS_PER_SECOND, from_micros, to_micros
+
+'''
+A local SQLite copy of Firestore collections. A full sync lists the collection
+with a projection on the document ID only (names and update times, no
+fields), then fetches the full contents of only the documents that are new or
+whose update time differs from the cached copy, and drops the documents that
+no longer exist. Firestore bills a read for every document a query returns,
+projection or not, so a full sync still costs a read per document.
+
+Collections whose documents carry a creation timestamp are synced by a cursor
+on it instead: only documents created since the newest one already cached
+(less an hour, for documents committed out of order) are queried. A cursor
+misses edits and deletes of older documents (post ratings, place merges
+rewriting events, notifications being seen), so those collections still get a
+full sync once the last one is a week old, on the first sync of a cache, and
+whenever one is asked for.
+
+Collection          Cursor field
+
+posts               timestamp
+events              createdAt
+notifications       timestamp
+queuewanttotastes   timestamp
+'''
+
+_GET_ALL_CHUNK_SIZE = 300
+_FULL_SYNC_INTERVAL = datetime.timedelta(days=7)
+_CURSOR_OVERLAP_MICROS = 3600 * MICROS_PER_SECOND
+
+COLLECTIONS_TO_CURSOR_FIELDS = {
+    'posts': 'timestamp',
+    'events': 'createdAt',
+    'notifications': 'timestamp',
+    'queuewanttotastes': 'timestamp',
+}
+
+class CachedReference:
+    def __init__(self, path):
+        self.path = path
+        self.id = path.split('/')[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, CachedReference) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f'CachedReference({self.path})'
+
+def _update_time_nanos(update_time):
+    if hasattr(update_time, 'timestamp_pb'):
+        update_time = update_time.timestamp_pb()
+    return update_time.seconds * 1_000_000_000 + update_time.nanos
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return {'__timestamp__': value.timestamp()}
+    if hasattr(value, 'path') and hasattr(value, 'id'):
+        return {'__reference__': value.path}
+    if hasattr(value, 'latitude') and hasattr(value, 'longitude'):
+        return {'__geopoint__': [value.latitude, value.longitude]}
+    if isinstance(value, list):
+        return [_encode_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _encode_value(v) for k, v in value.items()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, list):
+        return [_decode_value(v) for v in value]
+    if isinstance(value, dict):
+        if '__timestamp__' in value:
+            return datetime.datetime.fromtimestamp(value['__timestamp__'], tz=datetime.timezone.utc)
+        if '__reference__' in value:
+            return CachedReference(value['__reference__'])
+        if '__geopoint__' in value:
+            return tuple(value['__geopoint__'])
+        return {k: _decode_value(v) for k, v in value.items()}
+    return value
+
+def _get_cursor(doc_dict, cursor_field):
+    value = doc_dict.get(cursor_field) if cursor_field is not None else None
+    return to_micros(value) if isinstance(value, datetime.datetime) else MISSING
+
+class SnapshotCache:
+    def __init__(self, path, full_sync=False):
+        self.path = path
+        self.full_sync = full_sync
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                id TEXT NOT NULL,
+                update_time INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (collection, id)
+            )
+        ''')
+        # synced_at is the time of the last full sync
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS syncs (
+                collection TEXT PRIMARY KEY,
+                synced_at TEXT NOT NULL
+            )
+        ''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS cursors (
+                collection TEXT PRIMARY KEY,
+                cursor INTEGER NOT NULL
+            )
+        ''')
+        self.connection.commit()
+
+    def update_times(self, collection):
+        rows = self.connection.execute('SELECT id, update_time FROM documents WHERE collection = ?', (collection,))
+        return dict(rows)
+
+    def _cursor(self, collection):
+        row = self.connection.execute('SELECT cursor FROM cursors WHERE collection = ?', (collection,)).fetchone()
+        return None if row is None else row[0]
+
+    def _is_full_sync_due(self, collection):
+        row = self.connection.execute('SELECT synced_at FROM syncs WHERE collection = ?', (collection,)).fetchone()
+        if row is None:
+            return True
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(row[0]) >= _FULL_SYNC_INTERVAL
+
+    def _write_documents(self, collection, docs, cursor_field):
+        rows = []
+        cursor = MISSING
+        for d in docs:
+            doc_dict = d.to_dict()
+            cursor = max(cursor, _get_cursor(doc_dict, cursor_field))
+            rows.append((collection, d.id, _update_time_nanos(d.update_time), json.dumps(_encode_value(doc_dict))))
+        self.connection.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)', rows)
+        return cursor
+
+    def _save_cursor(self, collection, cursor):
+        cursor = max(cursor, self._cursor(collection) or MISSING)
+        if cursor != MISSING:
+            self.connection.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?)', (collection, cursor))
+
+    # returns the IDs of documents that were fetched and deleted so callers
+    # can maintain their own derived state incrementally; a sync by cursor
+    # never finds deleted documents
+    def sync(self, db, collection, full=False):
+        cursor_field = COLLECTIONS_TO_CURSOR_FIELDS.get(collection)
+        cursor = self._cursor(collection) if cursor_field is not None else None
+        if full or self.full_sync or cursor is None or self._is_full_sync_due(collection):
+            return self._sync_full(db, collection, cursor_field)
+        return self._sync_since(db, collection, cursor_field, cursor)
+
+    def _sync_full(self, db, collection, cursor_field):
+        print(f'Syncing {collection} to {self.path}...')
+        cached_update_times = self.update_times(collection)
+
+        stale_refs = []
+        seen_ids = set()
+        for d in db.collection(collection).select([firestore.FieldPath.document_id()]).stream():
+            seen_ids.add(d.id)
+            if cached_update_times.get(d.id) != _update_time_nanos(d.update_time):
+                stale_refs.append(d.reference)
+        deleted_ids = set(cached_update_times) - seen_ids
+
+        changed_ids = set()
+        cursor = MISSING
+        for i in range(0, len(stale_refs), _GET_ALL_CHUNK_SIZE):
+            docs = []
+            for d in db.get_all(stale_refs[i:i + _GET_ALL_CHUNK_SIZE]):
+                if not d.exists:
+                    deleted_ids.add(d.id)
+                    continue
+                changed_ids.add(d.id)
+                docs.append(d)
+            cursor = max(cursor, self._write_documents(collection, docs, cursor_field))
+        self.connection.executemany(
+            'DELETE FROM documents WHERE collection = ? AND id = ?',
+            [(collection, doc_id) for doc_id in deleted_ids]
+        )
+        self._save_cursor(collection, cursor)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO syncs VALUES (?, ?)',
+            (collection, datetime.datetime.now(datetime.timezone.utc).isoformat())
+        )
+        self.connection.commit()
+        print(f'Fetched {len(changed_ids)} changed and dropped {len(deleted_ids)} deleted {collection} out of {len(seen_ids)}...')
+        return changed_ids, deleted_ids
+
+    def _sync_since(self, db, collection, cursor_field, cursor):
+        since = from_micros(cursor - _CURSOR_OVERLAP_MICROS)
+        print(f'Syncing {collection} created since {since.isoformat()} to {self.path}...')
+        cached_update_times = self.update_times(collection)
+
+        docs = []
+        num_read = 0
+        for d in db.collection(collection).where(cursor_field, '>=', since).stream():
+            num_read += 1
+            if cached_update_times.get(d.id) != _update_time_nanos(d.update_time):
+                docs.append(d)
+        self._save_cursor(collection, self._write_documents(collection, docs, cursor_field))
+        self.connection.commit()
+        print(f'Fetched {len(docs)} changed {collection} out of {num_read} read...')
+        return {d.id for d in docs}, set()
+
+    def documents(self, collection):
+        rows = self.connection.execute('SELECT id, data FROM documents WHERE collection = ? ORDER BY id', (collection,))
+        for doc_id, data in rows:
+            yield doc_id, _decode_value(json.loads(data))
+
+    def document(self, collection, doc_id):
+        row = self.connection.execute(
+            'SELECT data FROM documents WHERE collection = ? AND id = ?',
+            (collection, doc_id)
+        ).fetchone()
+        return None if row is None else _decode_value(json.loads(row[0]))
@@ -0,0 +1,22 @@
+import json
+import os
+
+'''
+JSON files that incremental jobs use to remember what they already processed
+between runs. Writes go to a temporary file that is renamed over the old one
+so a crash never leaves a half-written state behind.
+'''
+
+def load_state(path, default=None):
+    if not os.path.exists(path):
+        return default
+    print(f'Loading state from {path}...')
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_state(path, state):
+    print(f'Saving state to {path}...')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,37 @@
+import datetime
+
+'''
+Timestamps are normalized once, when documents are loaded, to integer
+microseconds since the epoch (UTC). Integers compare, sort and subtract
+without building datetimes and keep Firestore's microsecond precision;
+datetimes are only built again for output. Missing timestamps are MISSING,
+which sorts before every real timestamp.
+'''
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROS_PER_SECOND = 1000000
+MICROS_PER_DAY = 86400 * MICROS_PER_SECOND
+MISSING = -2 ** 63
+
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# naive datetimes are taken to be in UTC, as Firestore stores them
+def to_micros(timestamp):
+    if timestamp is None:
+        return MISSING
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return (timestamp - EPOCH) // _MICROSECOND
+
+def from_micros(micros):
+    if micros == MISSING:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+def micros_to_seconds(micros):
+    if micros == MISSING:
+        return None
+    return micros / MICROS_PER_SECOND
+
+def now_micros():
+    return to_micros(datetime.datetime.now(datetime.timezone.utc))
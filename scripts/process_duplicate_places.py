@@ -2,106 +2,67 @@
 import argparse
 import firebase_admin
 import json
-from collections import namedtuple
 from firebase_admin import credentials, firestore
+from lib.duplicate_places import DEFAULT_GEOHASH_PRECISION, DEFAULT_THRESHOLD, Place, find_duplicate_places, get_merge_target
+from lib.place_merge import merge_places
+from lib.place_refs import get_place_ids_to_refs, load_place_refs, refresh_place_refs, save_place_refs
+from lib.snapshot import add_snapshot_arguments, load_snapshot
 from os import environ
 
-Place = namedtuple('Place', ['id', 'name', 'address'])
-
-def get_places():
+def get_places(snapshot):
     places = []
-    for place_doc in db.collection('places').stream():
-        name = place_doc.get('name')
-        address = place_doc.get('address')
-        places.append(Place(id=place_doc.id, name=name, address=address))
+    for p, d in snapshot.places.rows():
+        places.append(Place(id=p, name=d['name'], address=d['address'], latitude=d['latitude'], longitude=d['longitude'], posts_count=d['postsCount']))
     return places
 
-def create_places_dictionary(places):
-    places_dictionary = {}
-    for place in places:
-        address = place.address
-        if address in places_dictionary:
-            places_dictionary[address].append(place)
-        else:
-            places_dictionary[address] = [place]
-    return places_dictionary
-
-def replace_places(target_id, remove_ids):
-    target_place = db.collection('places').document(target_id)
-    for remove_id in remove_ids:
-        remove_place = db.collection('places').document(remove_id)
-
-        # Updated 'place' fields of 'queuewanttotastes'
-        queue_want_to_tastes = db.collection('queuewanttotastes').where('place', '==', remove_place).stream()
-        for w in queue_want_to_tastes:
-            print(f'Updating queue want to taste {w.id}...')
-            want_to_taste = db.collection('queuewanttotastes').document(w.id)
-            want_to_taste.update({
-                'place': target_place
-            })
-
-        # Update 'tasted' fields of users
-        users = db.collection('users').where('tasted', 'array_contains', remove_place).stream()
-        for u in users:
-            print(f'Updating user (tasted) {u.id}...')
-            user = db.collection('users').document(u.id)
-            user.update({
-                'tasted': firestore.ArrayRemove([remove_place])
-            })
-            user.update({
-                'tasted': firestore.ArrayUnion([target_place])
-            })
-
-        # Update 'wantToTaste' fields of users
-        users = db.collection('users').where('wantToTaste', 'array_contains', remove_place).stream()
-        for u in users:
-            print(f'Updating user (wantToTaste) {u.id}...')
-            user = db.collection('users').document(u.id)
-            user.update({
-                'wantToTaste': firestore.ArrayRemove([remove_place])
-            })
-            user.update({
-                'wantToTaste': firestore.ArrayUnion([target_place])
-            })
-
-        # Update 'notificationLink' fields of notifications
-        notifications = db.collection('notifications').where('notificationLink', '==', remove_id).stream()
-        for n in notifications:
-            print(f'Updating notification {n.id}...')
-            notification = db.collection('notifications').document(n.id)
-            notification.update({
-                'notificationLink': target_id
-            })
-
-        # Update 'place' fields of posts
-        posts = db.collection('posts').where('place', '==', remove_place).stream()
-        for p in posts:
-            print(f'Updating post {p.id}...')
-            post = db.collection('posts').document(p.id)
-            post.update({
-                'place': target_place
-            })
-
-        # Delete places
-        remove_place.delete()
-
-def process_duplicate_places(duplicate_places):
-    print(f'There are {len(duplicate_places)} places that need to be processed...')
-    for places in duplicate_places:
-        print('Processing batch of duplicate places:')
-        for i in range(len(places)):
-            place = places[i]
-            print(f'{i}: {place.name}, {place.address}')
-        index = int(input('Select a place index to use: '))
-        if index >= len(places):
-            print('WARNING: invalid index, continuing')
-            continue
-        replace_places(places[index].id, [p.id for p in places if p.id != places[index].id])
+def _to_plan_place(place, place_ids_to_refs):
+    plan_place = {
+        'id': place.id,
+        'name': place.name,
+        'address': place.address,
+        'postsCount': place.posts_count
+    }
+    if place_ids_to_refs is not None:
+        plan_place['references'] = {k: len(v) for k, v in sorted(place_ids_to_refs.get(place.id, {}).items())}
+    return plan_place
+
+def create_merge_plan(places, threshold=DEFAULT_THRESHOLD, precision=DEFAULT_GEOHASH_PRECISION, place_ids_to_refs=None):
+    print('Finding duplicate places...')
+    merges = []
+    for group_places, group_pairs in find_duplicate_places(places, threshold, precision):
+        target = get_merge_target(group_places)
+        merges.append({
+            'target': target.id,
+            'remove': sorted(p.id for p in group_places if p.id != target.id),
+            'places': [_to_plan_place(p, place_ids_to_refs) for p in sorted(group_places, key=lambda p: p.id)],
+            'pairs': [[a, b, round(score, 3)] for a, b, score in group_pairs]
+        })
+    merges.sort(key=lambda m: m['target'])
+    return {'merges': merges}
+
+def print_merge_plan(merge_plan):
+    print(f'There are {len(merge_plan["merges"])} groups of duplicate places:')
+    for merge in merge_plan['merges']:
+        for place in merge['places']:
+            action = 'keep' if place['id'] == merge['target'] else 'remove'
+            print(f'{action:>6} {place["id"]}: {place["name"]}, {place["address"]} ({place["postsCount"]} posts)')
+            if 'references' in place:
+                print(f'       referenced by {", ".join(f"{c} {k}" for k, c in place["references"].items()) or "nothing"}')
+        print()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--plan-path', type=str, required=True)
+    parser.add_argument('--apply', action='store_true')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--geohash-precision', type=int, default=DEFAULT_GEOHASH_PRECISION)
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--place-refs-path', type=str, required=False)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
+    if args.apply and args.place_refs_path and not args.snapshot_cache_path:
+        parser.error('--apply with --place-refs-path requires --snapshot-cache-path so the index is synced before the merge')
 
     token_dict = None
     with open(args.cert_path, 'r') as f:
@@ -117,10 +78,28 @@ if __name__ == '__main__':
 
     db = firestore.client()
 
-    places = get_places()
-    places_dictionary = create_places_dictionary(places)
-    duplicate_places = []
-    for address, places in places_dictionary.items():
-        if len(places) > 1:
-            duplicate_places.append(places)
-    process_duplicate_places(duplicate_places)
+    # the place reference index is refreshed from the snapshot (from the synced
+    # cache when there is one) so merges look up the documents to rewrite
+    # instead of querying for them
+    snapshot = None
+    place_ids_to_refs = None
+    if args.place_refs_path:
+        snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+        place_refs = load_place_refs(args.place_refs_path)
+        refresh_place_refs(place_refs, snapshot)
+        save_place_refs(args.place_refs_path, place_refs)
+        place_ids_to_refs = get_place_ids_to_refs(place_refs)
+
+    # finding duplicates only writes a plan, which is reviewed (and edited if
+    # needed) before being applied with --apply
+    if args.apply:
+        with open(args.plan_path, 'r') as f:
+            merge_plan = json.load(f)
+        merge_places(db, merge_plan, args.max_workers, place_ids_to_refs)
+    else:
+        snapshot = snapshot or load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+        merge_plan = create_merge_plan(get_places(snapshot), args.threshold, args.geohash_precision, place_ids_to_refs)
+        print_merge_plan(merge_plan)
+        print(f'Writing merge plan to {args.plan_path}...')
+        with open(args.plan_path, 'w') as f:
+            json.dump(merge_plan, f, indent=2)
@@ -7,42 +7,39 @@ import json
 import pytz
 import random
 from firebase_admin import auth, credentials, firestore
+from lib.auth_users import get_user_ids_to_auth_timestamps
+from lib.notifications import NotificationWriter
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+from lib.timestamps import MICROS_PER_DAY, now_micros
 from os import environ
 
-def get_user_ids_to_data(db):
-    print('Getting authenticated users...')
+def get_user_ids_to_data(snapshot):
     user_ids_to_data = {}
-    for u in auth.list_users().iterate_all():
-        auth_user = auth.get_user(u.uid)
-        users = db.collection('users').where('phoneNumber', '==', u.phone_number).get()
-        if len(users) != 1:
-            continue
-        epoch_creation_timestamp = auth_user.user_metadata.creation_timestamp / 1000
-        user = users[0]
-        user_ids_to_data[user.id] = {
-            'firstName': user.get('firstName'),
-            'handle': user.get('handle'),
-            'friends': user.get('friends'),
-            'timestamp': datetime.datetime.fromtimestamp(epoch_creation_timestamp).replace(tzinfo=pytz.UTC)
+    for u, timestamp in get_user_ids_to_auth_timestamps(snapshot).items():
+        user = snapshot.users.get(u)
+        user_ids_to_data[u] = {
+            'firstName': user['firstName'],
+            'handle': user['handle'],
+            'friends': user['friends'],
+            'timestamp': timestamp
         }
     return user_ids_to_data
 
-def get_post_ids_to_data(db):
-    print('Getting posts...')
+def get_post_ids_to_data(snapshot):
+    posts = snapshot.posts
     post_ids_to_data = {}
-    posts = db.collection('posts').get()
-    for p in posts:
-        post_ids_to_data[p.id] = {
-            'user': p.get('user').id,
-            'timestamp': p.get('timestamp').replace(tzinfo=pytz.UTC)
+    for i, p in enumerate(posts.ids):
+        post_ids_to_data[p] = {
+            'user': posts['user'][i],
+            'timestamp': posts['timestamp'][i]
         }
     return post_ids_to_data
 
 def get_last_week_users(user_ids_to_data, post_ids_to_data):
     print('Getting users who posted and did not post in the last week...')
     all_users = set(user_ids_to_data.keys())
-    now = datetime.datetime.now().replace(tzinfo=pytz.UTC)
-    delta = datetime.timedelta(days=7)
+    now = now_micros()
+    delta = 7 * MICROS_PER_DAY
 
     posts_in_last_week = [d for p, d in post_ids_to_data.items() if d['timestamp'] > now - delta]
     users_who_posted = set([p['user'] for p in posts_in_last_week])
@@ -56,12 +53,14 @@ def create_friend_graph_by_ids(user_ids_to_data):
     print('Creating friend graph...')
     friend_graph = {}
     for u, d in user_ids_to_data.items():
-        friend_graph[u] = [i.id for i in d['friends']]
+        friend_graph[u] = list(d['friends'])
     return friend_graph
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--max-workers', type=int, default=8)
+    add_snapshot_arguments(parser)
     args = parser.parse_args()
 
     token_dict = None
@@ -77,8 +76,9 @@ if __name__ == '__main__':
             exit(0)
 
     db = firestore.client()
-    user_ids_to_data = get_user_ids_to_data(db)
-    post_ids_to_data = get_post_ids_to_data(db)
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = get_user_ids_to_data(snapshot)
+    post_ids_to_data = get_post_ids_to_data(snapshot)
     friend_graph = create_friend_graph_by_ids(user_ids_to_data)
     users_who_posted, users_who_did_not_post = get_last_week_users(user_ids_to_data, post_ids_to_data)
 
@@ -88,37 +88,38 @@ if __name__ == '__main__':
         'Share new places with your friends',
     ])
 
-    for u in users_who_did_not_post:
-        print(f'Processing user {user_ids_to_data[u]["handle"]}...')
-        user = user_ids_to_data[u]
-        friends_who_posted = list(users_who_posted.intersection(set([f.id for f in user['friends']])))
-
-        payload = {
-            'ownerId': u,
-            'type': 'AddTasteReminder',
-            'title': rand_title,
-            'body': '',
-            'notificationIcon': 'ADD_TASTE',
-            'notificationLink': 'ADD_TASTE',
-            'seen': False,
-            'timestamp': firestore.SERVER_TIMESTAMP
-        }
-
-        if len(friends_who_posted) == 0:
-            payload['body'] = 'Let them know where you went last week - add a taste'
-        elif len(friends_who_posted) == 1:
-            friend_name = user_ids_to_data[friends_who_posted[0]]['firstName']
-            payload['body'] = f'{friend_name} added a taste in the last week - add yours'
-        elif len(friends_who_posted) == 2:
-            friend1_name = user_ids_to_data[friends_who_posted[0]]['firstName']
-            friend2_name = user_ids_to_data[friends_who_posted[1]]['firstName']
-            payload['body'] = f'{friend1_name} and {friend2_name} added tastes in the last week - add yours'
-        else:
-            rand_friends = random.sample(friends_who_posted, 3)
-            friend1_name = user_ids_to_data[rand_friends[0]]['firstName']
-            friend2_name = user_ids_to_data[rand_friends[1]]['firstName']
-            friend3_name = user_ids_to_data[rand_friends[2]]['firstName']
-            payload['body'] = f'{friend1_name}, {friend2_name}, and {friend3_name} added tastes in the last week - add yours'
-
-        print(f'Creating notification {payload}...')
-        db.collection('notifications').add(payload)
+    with NotificationWriter(db, max_workers=args.max_workers) as notification_writer:
+        for u in users_who_did_not_post:
+            print(f'Processing user {user_ids_to_data[u]["handle"]}...')
+            user = user_ids_to_data[u]
+            friends_who_posted = list(users_who_posted.intersection(set(user['friends'])))
+
+            payload = {
+                'ownerId': u,
+                'type': 'AddTasteReminder',
+                'title': rand_title,
+                'body': '',
+                'notificationIcon': 'ADD_TASTE',
+                'notificationLink': 'ADD_TASTE',
+                'seen': False,
+                'timestamp': firestore.SERVER_TIMESTAMP
+            }
+
+            if len(friends_who_posted) == 0:
+                payload['body'] = 'Let them know where you went last week - add a taste'
+            elif len(friends_who_posted) == 1:
+                friend_name = user_ids_to_data[friends_who_posted[0]]['firstName']
+                payload['body'] = f'{friend_name} added a taste in the last week - add yours'
+            elif len(friends_who_posted) == 2:
+                friend1_name = user_ids_to_data[friends_who_posted[0]]['firstName']
+                friend2_name = user_ids_to_data[friends_who_posted[1]]['firstName']
+                payload['body'] = f'{friend1_name} and {friend2_name} added tastes in the last week - add yours'
+            else:
+                rand_friends = random.sample(friends_who_posted, 3)
+                friend1_name = user_ids_to_data[rand_friends[0]]['firstName']
+                friend2_name = user_ids_to_data[rand_friends[1]]['firstName']
+                friend3_name = user_ids_to_data[rand_friends[2]]['firstName']
+                payload['body'] = f'{friend1_name}, {friend2_name}, and {friend3_name} added tastes in the last week - add yours'
+
+            print(f'Creating notification {payload}...')
+            notification_writer.add(payload)
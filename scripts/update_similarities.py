@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import argparse
+import firebase_admin
+import json
+import math
+from calculate_initial_similarities import calculate_friend_sets, get_similarity_ids_to_data, get_user_ids_to_data
+from firebase_admin import credentials, firestore
+from lib.batch_writer import BatchWriter
+from lib.similarity import calculate_pair_stats, calculate_score, get_pair_ids_to_similarity_ids
+from lib.snapshot import add_snapshot_arguments, load_snapshot
+from lib.state import load_state, save_state
+from lib.timestamps import MISSING, from_micros
+from os import environ
+
+'''
+State
+
+watermark       epoch microseconds of the newest post in the snapshot last applied
+posts           post ID -> [user ID, place ID, star rating] of every rated post
+tasted          user ID -> place IDs in the user's tasted
+pairs           "<user ID>/<user ID>" (sorted) -> {count, diff, score, similarityId, lookup}
+
+Each run compares the snapshot's posts and tasted lists with the state, so
+added, edited and deleted posts are all picked up. A pair's count and diff
+are sums over places, so only the changed places are taken out with their old
+ratings and put back in with their new ones. Pairs of new friends are
+calculated in full. Like calculate_initial_similarities.py and the per-post
+trigger, a place only counts for a pair if it is in both users' tasted (and
+both rated it).
+
+score is the score last written to the pair's similarity document. lookup
+marks pairs without a single known similarity document, which are looked up
+before writing since the per-post trigger may have created one.
+'''
+
+def _pair_key(u1, u2):
+    return '/'.join(sorted([u1, u2]))
+
+# returns post ID -> [user ID, place ID, star rating] of the rated posts and
+# the timestamp of the newest post
+def _get_snapshot_posts(snapshot):
+    posts = snapshot.posts
+    post_ids_to_ratings = {}
+    watermark = MISSING
+    for i, post_id in enumerate(posts.ids):
+        watermark = max(watermark, posts['timestamp'][i])
+        star_rating = posts['starRating'][i]
+        if math.isnan(star_rating) or posts['user'][i] is None or posts['place'][i] is None:
+            continue
+        post_ids_to_ratings[post_id] = [posts['user'][i], posts['place'][i], star_rating]
+    return post_ids_to_ratings, watermark
+
+# maps user IDs to place IDs to [sum of star ratings, number of posts]
+def _get_ratings(post_ids_to_ratings):
+    ratings = {}
+    for u, p, star_rating in post_ids_to_ratings.values():
+        rating = ratings.setdefault(u, {}).setdefault(p, [0, 0])
+        rating[0] += star_rating
+        rating[1] += 1
+    return ratings
+
+def _get_tasted(user_ids_to_data):
+    return {u: sorted(set(d['tasted'])) for u, d in user_ids_to_data.items()}
+
+# returns the count and diff a place adds to a pair
+def _calculate_place_stats(ratings, user_ids_to_tasted, u1, u2, p):
+    r1 = ratings.get(u1, {}).get(p)
+    r2 = ratings.get(u2, {}).get(p)
+    if r1 is None or r2 is None or p not in user_ids_to_tasted.get(u1, ()) or p not in user_ids_to_tasted.get(u2, ()):
+        return 0, 0
+    return 1, abs(r1[0] / r1[1] - r2[0] / r2[1])
+
+def _calculate_pair_stats_from_ratings(ratings, user_ids_to_tasted, u1, u2):
+    user_ids_to_rated_place_ids = {}
+    user_place_ratings = {}
+    for u in [u1, u2]:
+        tasted = user_ids_to_tasted.get(u, set())
+        user_ids_to_rated_place_ids[u] = {p for p in ratings.get(u, {}) if p in tasted}
+        for p, (rating_sum, rating_count) in ratings.get(u, {}).items():
+            user_place_ratings[(u, p)] = rating_sum / rating_count
+    return calculate_pair_stats(u1, u2, user_ids_to_rated_place_ids, user_place_ratings)
+
+def _new_pair(ratings, user_ids_to_tasted, u1, u2, similarity_ids=None, similarity_ids_to_data=None):
+    count, diff = _calculate_pair_stats_from_ratings(ratings, user_ids_to_tasted, u1, u2)
+    similarity_id = similarity_ids[0] if similarity_ids is not None and len(similarity_ids) == 1 else None
+    return {
+        'count': count,
+        'diff': diff,
+        'score': similarity_ids_to_data[similarity_id]['score'] if similarity_id else None,
+        'similarityId': similarity_id,
+        'lookup': similarity_id is None
+    }
+
+def build_similarity_state(snapshot, user_ids_to_data):
+    print('Building similarity state from snapshot...')
+    post_ids_to_ratings, watermark = _get_snapshot_posts(snapshot)
+    ratings = _get_ratings(post_ids_to_ratings)
+    tasted = _get_tasted(user_ids_to_data)
+    user_ids_to_tasted = {u: set(t) for u, t in tasted.items()}
+
+    similarity_ids_to_data = get_similarity_ids_to_data(snapshot)
+    pair_ids_to_similarity_ids = get_pair_ids_to_similarity_ids(similarity_ids_to_data)
+    pairs = {}
+    for fs in calculate_friend_sets(user_ids_to_data):
+        u1, u2 = fs
+        pairs[_pair_key(u1, u2)] = _new_pair(ratings, user_ids_to_tasted, u1, u2, pair_ids_to_similarity_ids.get(fs, []), similarity_ids_to_data)
+    return {
+        'watermark': watermark,
+        'posts': post_ids_to_ratings,
+        'tasted': tasted,
+        'pairs': pairs
+    }
+
+# applies the posts and tasted lists of a snapshot to the state and returns the
+# keys of the pairs whose stats may have changed
+def update_similarity_state(state, snapshot, user_ids_to_data):
+    post_ids_to_ratings, watermark = _get_snapshot_posts(snapshot)
+    tasted = _get_tasted(user_ids_to_data)
+
+    # (user ID, place ID) of every rating or tasted entry that changed
+    changed_user_places = set()
+    num_changed_posts = 0
+    for post_id in state['posts'].keys() | post_ids_to_ratings.keys():
+        old_post = state['posts'].get(post_id)
+        new_post = post_ids_to_ratings.get(post_id)
+        if old_post == new_post:
+            continue
+        num_changed_posts += 1
+        for post in [old_post, new_post]:
+            if post is not None:
+                changed_user_places.add((post[0], post[1]))
+    for u in state['tasted'].keys() | tasted.keys():
+        for p in set(state['tasted'].get(u, [])) ^ set(tasted.get(u, [])):
+            changed_user_places.add((u, p))
+    print(f'Applying {num_changed_posts} added, edited or deleted posts (newest from {from_micros(watermark)}) and {len(changed_user_places)} changed ratings and tastes...')
+
+    old_ratings = _get_ratings(state['posts'])
+    old_user_ids_to_tasted = {u: set(t) for u, t in state['tasted'].items()}
+    ratings = _get_ratings(post_ids_to_ratings)
+    user_ids_to_tasted = {u: set(t) for u, t in tasted.items()}
+
+    pairs = state['pairs']
+    pair_keys = {_pair_key(*fs) for fs in calculate_friend_sets(user_ids_to_data)}
+    for key in pairs.keys() - pair_keys:
+        del pairs[key]
+    user_ids_to_pair_keys = {}
+    for key in pairs:
+        for u in key.split('/'):
+            user_ids_to_pair_keys.setdefault(u, []).append(key)
+
+    pair_keys_to_place_ids = {}
+    for u, p in changed_user_places:
+        for key in user_ids_to_pair_keys.get(u, []):
+            pair_keys_to_place_ids.setdefault(key, set()).add(p)
+    for key, place_ids in pair_keys_to_place_ids.items():
+        u1, u2 = key.split('/')
+        pair = pairs[key]
+        for p in place_ids:
+            old_count, old_diff = _calculate_place_stats(old_ratings, old_user_ids_to_tasted, u1, u2, p)
+            count, diff = _calculate_place_stats(ratings, user_ids_to_tasted, u1, u2, p)
+            pair['count'] += count - old_count
+            pair['diff'] += diff - old_diff
+
+    new_pair_keys = pair_keys - pairs.keys()
+    for key in new_pair_keys:
+        u1, u2 = key.split('/')
+        pairs[key] = _new_pair(ratings, user_ids_to_tasted, u1, u2)
+
+    state['watermark'] = watermark
+    state['posts'] = post_ids_to_ratings
+    state['tasted'] = tasted
+    return pair_keys_to_place_ids.keys() | new_pair_keys
+
+def _find_similarity_id(db, u1, u2):
+    similarities = db.collection('similarities').where(f'users.{u1}', '==', True).where(f'users.{u2}', '==', True).get()
+    if len(similarities) > 1:
+        print(f'WARNING: multiple similarities for {u1}/{u2}, omitting...')
+        return None, True
+    return (similarities[0].id if len(similarities) == 1 else None), False
+
+def upsert_pair_similarity(db, writer, state, key, user_ids_to_data):
+    pair = state['pairs'][key]
+    score = calculate_score(pair['count'], pair['diff'])
+    if score is None or (pair['score'] is not None and math.isclose(pair['score'], score, abs_tol=1e-9)):
+        return
+    u1, u2 = key.split('/')
+    u1_handle = user_ids_to_data[u1]['handle']
+    u2_handle = user_ids_to_data[u2]['handle']
+
+    # the pair may already have a similarity written by the per-post trigger
+    if pair['lookup']:
+        similarity_id, ambiguous = _find_similarity_id(db, u1, u2)
+        if ambiguous:
+            return
+        pair['similarityId'] = similarity_id
+        pair['lookup'] = False
+
+    if pair['similarityId'] is not None:
+        print(f'Updating similarity of {round(score, 2)} for {u1_handle}/{u2_handle}...')
+        writer.update(db.collection('similarities').document(pair['similarityId']), {
+            'score': score
+        })
+    else:
+        print(f'Inserting similarity of {round(score, 2)} for {u1_handle}/{u2_handle}...')
+        similarity_ref = db.collection('similarities').document()
+        writer.set(similarity_ref, {
+            'users': {
+                u1: True,
+                u2: True,
+            },
+            'score': score,
+        })
+        pair['similarityId'] = similarity_ref.id
+    pair['score'] = score
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cert-path', type=str, required=True)
+    parser.add_argument('--state-path', type=str, required=True)
+    parser.add_argument('--rebuild', action='store_true')
+    parser.add_argument('--max-workers', type=int, default=8)
+    add_snapshot_arguments(parser)
+    args = parser.parse_args()
+
+    token_dict = None
+    with open(args.cert_path, 'r') as f:
+        token_dict = json.load(f)
+
+    credentials = credentials.Certificate(token_dict)
+    firebase_admin.initialize_app(credentials)
+
+    if not 'FIRESTORE_EMULATOR_HOST' in environ and 'BYPASS_FIREBASE_PRODUCTION_PROMPT' not in environ:
+        confirm = input('WARNING: connected to production, type "y" to continue: ')
+        if confirm != "y":
+            exit(0)
+
+    db = firestore.client()
+    snapshot = load_snapshot(db, args.snapshot_path, args.snapshot_cache_path)
+    user_ids_to_data = get_user_ids_to_data(snapshot)
+
+    state = None if args.rebuild else load_state(args.state_path)
+    if state is None:
+        state = build_similarity_state(snapshot, user_ids_to_data)
+        affected_pair_keys = set(state['pairs'].keys())
+    else:
+        affected_pair_keys = update_similarity_state(state, snapshot, user_ids_to_data)
+
+    print(f'Upserting similarities for {len(affected_pair_keys)} pairs...')
+    with BatchWriter(db, 'similarities', max_workers=args.max_workers) as writer:
+        for key in sorted(affected_pair_keys):
+            upsert_pair_similarity(db, writer, state, key, user_ids_to_data)
+    save_state(args.state_path, state)